@@ -0,0 +1,53 @@
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+
+class ResponseCache:
+    """LRU of serialized responses bounded by their total size in bytes.
+
+    Every entry is stored with the version of the data it was built from,
+    a lookup with another version is a miss. Versions live in the database,
+    so entries stay correct across workers without any invalidation messages.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries: OrderedDict[Hashable, Tuple[int | None, bytes]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, version: int | None) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    # empty bodies are never valid responses and are not kept
+    def put(self, key: Hashable, version: int | None, body: bytes) -> None:
+        if not body or len(body) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[1])
+        self.entries[key] = (version, body)
+        self.bytes += len(body)
+        while self.bytes > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int | float]:
+        requests = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hitRate": self.hits / requests if requests else 0.0,
+        }
@@ -0,0 +1,154 @@
+# Feed of the change log for /changes. Every worker listens for change
+# notifications on one connection, reads new changes once and keeps the
+# latest of them encoded in memory, so waiting subscribers cost nothing
+# until something changes and then get the changes without a query.
+import asyncio
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from typing import Callable, Deque, List, Tuple
+
+import asyncpg
+from loguru import logger
+
+from config import (
+    CHANGES_POLL_SECONDS,
+    DATABASE_HOST,
+    DATABASE_PORT,
+    POSTGRES_DB,
+    POSTGRES_PASSWORD,
+    POSTGRES_USER,
+)
+from database import Session
+from db_requests import CHANGES_CHANNEL, firstChange, getChanges, lastChange
+from serializers import dump_change_json
+
+# a change with its log number and encoded for the feed
+Change = Tuple[int, bytes]
+
+
+# Call `notified` on every change notification, on every reconnect and
+# every `poll_seconds` in case a notification is lost. Runs until cancelled,
+# reconnecting when the connection is lost.
+async def listen(notified: Callable[[], None], name: str, poll_seconds: float) -> None:
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(
+                user=POSTGRES_USER,
+                password=POSTGRES_PASSWORD,
+                host=DATABASE_HOST,
+                port=DATABASE_PORT,
+                database=POSTGRES_DB,
+            )
+            closed = asyncio.Event()
+            connection.add_termination_listener(lambda _: closed.set())
+            await connection.add_listener(CHANGES_CHANNEL, lambda *args: notified())
+            # catch up on changes made while there was no listener
+            notified()
+            while not closed.is_set():
+                try:
+                    await asyncio.wait_for(closed.wait(), poll_seconds)
+                except asyncio.TimeoutError:
+                    notified()
+            logger.warning(f"{name}: listener connection lost")
+        except (OSError, asyncpg.PostgresError) as e:
+            logger.warning(f"{name}: cannot listen for changes: {e}")
+        finally:
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+        await asyncio.sleep(poll_seconds)
+
+
+class ChangeFeed:
+    """Latest changes of the change log, shared by the subscribers of a worker.
+
+    Changes after `after` up to `seq` are held in `recent`, older ones are
+    read from the database. No change before a read one commits later
+    (see lockChangeLog), so reading after the last known number misses
+    nothing.
+    Items are the states of units when the change was read, a unit
+    changed twice comes with its latest state both times.
+    """
+
+    def __init__(self, size: int):
+        self.recent: Deque[Change] = deque()
+        self.size = size
+        self.after = 0
+        self.seq = 0
+        self.changed: asyncio.Event | None = None
+        self.dirty = False
+        self.reading: asyncio.Task | None = None
+        self.listening: asyncio.Task | None = None
+
+    # started once, a failed start can be repeated
+    async def start(self) -> None:
+        if self.listening is not None:
+            return
+        async with Session() as session:
+            self.after = self.seq = await lastChange(session)
+        self.changed = asyncio.Event()
+        self.listening = asyncio.create_task(
+            listen(self._notified, "changes", CHANGES_POLL_SECONDS)
+        )
+
+    async def stop(self) -> None:
+        for task in (self.listening, self.reading):
+            if task is not None:
+                task.cancel()
+
+    # Changes after `since`, at most `limit` of them, None if some of them
+    # were removed from the log by maintenance.py
+    async def read(self, since: int, limit: int) -> List[Change] | None:
+        if since >= self.after:
+            first = bisect_right(self.recent, since, key=lambda change: change[0])
+            return list(islice(self.recent, first, first + limit))
+        async with Session() as session:
+            oldest = await firstChange(session)
+            if oldest is not None and oldest > since + 1:
+                return None
+            rows = await getChanges(session, since, limit)
+        return [(row.seq, dump_change_json(row)) for row in rows]
+
+    # changes after `since` as soon as there are any, empty after `timeout`
+    async def wait(self, since: int, limit: int, timeout: float) -> List[Change] | None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            changed = self.changed
+            changes = await self.read(since, limit)
+            if changes is None or changes:
+                return changes
+            try:
+                await asyncio.wait_for(changed.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                return []
+
+    def _notified(self) -> None:
+        self.dirty = True
+        if self.reading is None or self.reading.done():
+            self.reading = asyncio.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        while self.dirty:
+            self.dirty = False
+            try:
+                await self._read_new()
+            except Exception:
+                logger.exception("changes: read failed")
+
+    async def _read_new(self) -> None:
+        while True:
+            async with Session() as session:
+                rows = await getChanges(session, self.seq, self.size)
+            for row in rows:
+                self.recent.append((row.seq, dump_change_json(row)))
+                self.seq = row.seq
+            while len(self.recent) > self.size:
+                self.after = self.recent.popleft()[0]
+            if rows:
+                # wake up everyone waiting, later waiters get a new event
+                self.changed.set()
+                self.changed = asyncio.Event()
+            if len(rows) < self.size:
+                return
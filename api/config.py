@@ -10,6 +10,11 @@ class Mode(enum.Enum):
 MODE = Mode(getenv("MODE"))
 
 
+class TreeMode(enum.Enum):
+    DATABASE = "DATABASE"
+    MEMORY = "MEMORY"
+
+
 STRING_SIZE = 256
 
 POSTGRES_USER = getenv("POSTGRES_USER")
@@ -17,3 +22,72 @@ POSTGRES_PASSWORD = getenv("POSTGRES_PASSWORD")
 DATABASE_HOST = getenv("DATABASE_HOST")
 DATABASE_PORT = getenv("DATABASE_PORT")
 POSTGRES_DB = getenv("POSTGRES_DB")
+
+# database connection pool of every worker
+POOL_SIZE = int(getenv("POOL_SIZE", "10"))
+POOL_MAX_OVERFLOW = int(getenv("POOL_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(getenv("POOL_TIMEOUT", "5"))
+POOL_RECYCLE = int(getenv("POOL_RECYCLE", "1800"))
+# connections opened by every worker at startup, hot statements are prepared on each
+POOL_WARMUP = min(int(getenv("POOL_WARMUP", str(POOL_SIZE))), POOL_SIZE)
+# a worker started before the database retries the warm-up this often
+WARMUP_RETRY_SECONDS = float(getenv("WARMUP_RETRY_SECONDS", "1"))
+
+# per worker cache of /nodes responses, bytes of serialized bodies
+NODE_CACHE_BYTES = int(getenv("NODE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+# /nodes responses with more units are streamed in chunks and not cached
+NODE_STREAM_THRESHOLD = int(getenv("NODE_STREAM_THRESHOLD", "10000"))
+
+# most ids in one /nodes?ids= request
+NODES_BATCH_SIZE = int(getenv("NODES_BATCH_SIZE", "100"))
+
+# /nodes trees of this many largest root folders are cached at startup
+NODE_CACHE_PRELOAD = int(getenv("NODE_CACHE_PRELOAD", "0"))
+
+# /updates pages of requests with a cursor and no limit, also the batch size
+# of the full response, which is streamed
+UPDATES_PAGE_SIZE = int(getenv("UPDATES_PAGE_SIZE", "1000"))
+UPDATES_MAX_PAGE_SIZE = int(getenv("UPDATES_MAX_PAGE_SIZE", "10000"))
+
+# /node/{id}/history pages of requests with a cursor and no limit, also the
+# batch size of the full history, which is streamed
+HISTORY_PAGE_SIZE = int(getenv("HISTORY_PAGE_SIZE", "1000"))
+HISTORY_MAX_PAGE_SIZE = int(getenv("HISTORY_MAX_PAGE_SIZE", "10000"))
+
+# requests slower than this are logged together with their SQL statistics
+SLOW_REQUEST_SECONDS = float(getenv("SLOW_REQUEST_SECONDS", "1"))
+
+# Where /nodes trees are read from: DATABASE queries every request, MEMORY
+# keeps a compact copy of the hierarchy in every worker (see tree.py)
+TREE_ENGINE = TreeMode(getenv("TREE_ENGINE", "DATABASE"))
+# the in-memory tree also polls for changes in case a notification is lost
+TREE_POLL_SECONDS = float(getenv("TREE_POLL_SECONDS", "5"))
+TREE_SYNC_BATCH = int(getenv("TREE_SYNC_BATCH", "10000"))
+
+# items of a bulk import copied to its staging table at once
+BULK_BATCH_SIZE = int(getenv("BULK_BATCH_SIZE", "10000"))
+
+# /changes feed: changes kept encoded in memory by every worker, pages of
+# long-polls, how long they wait for a change, and keep-alive comments of
+# the event stream; the feed also polls in case a notification is lost
+CHANGES_BUFFER_SIZE = int(getenv("CHANGES_BUFFER_SIZE", "10000"))
+CHANGES_PAGE_SIZE = int(getenv("CHANGES_PAGE_SIZE", "1000"))
+CHANGES_MAX_PAGE_SIZE = int(getenv("CHANGES_MAX_PAGE_SIZE", "10000"))
+CHANGES_WAIT_SECONDS = float(getenv("CHANGES_WAIT_SECONDS", "30"))
+CHANGES_MAX_WAIT_SECONDS = float(getenv("CHANGES_MAX_WAIT_SECONDS", "60"))
+CHANGES_KEEPALIVE_SECONDS = float(getenv("CHANGES_KEEPALIVE_SECONDS", "15"))
+CHANGES_POLL_SECONDS = float(getenv("CHANGES_POLL_SECONDS", "5"))
+
+# maintenance.py: monthly history partitions created ahead of time, and
+# changes kept in the change log when it is trimmed
+PARTITIONS_AHEAD = int(getenv("PARTITIONS_AHEAD", "2"))
+CHANGES_KEEP = int(getenv("CHANGES_KEEP", "1000000"))
+
+# a write chosen as a deadlock victim is run again up to this many times
+WRITE_RETRIES = int(getenv("WRITE_RETRIES", "3"))
+
+# A write locking more units than this takes the write lock exclusively
+# instead, like a bulk import: every advisory lock takes a slot of the
+# shared lock table of max_locks_per_transaction * max_connections.
+UNIT_LOCKS_MAX = int(getenv("UNIT_LOCKS_MAX", "1000"))
@@ -0,0 +1,36 @@
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from config import (
+    DATABASE_HOST,
+    DATABASE_PORT,
+    POOL_MAX_OVERFLOW,
+    POOL_RECYCLE,
+    POOL_SIZE,
+    POOL_TIMEOUT,
+    POSTGRES_DB,
+    POSTGRES_PASSWORD,
+    POSTGRES_USER,
+)
+from metrics import InstrumentedPool, instrument_engine
+
+engine = create_async_engine(
+    f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{POSTGRES_DB}",
+    pool_size=POOL_SIZE,
+    max_overflow=POOL_MAX_OVERFLOW,
+    pool_timeout=POOL_TIMEOUT,
+    pool_recycle=POOL_RECYCLE,
+    pool_pre_ping=True,
+    poolclass=InstrumentedPool,
+)
+instrument_engine(engine.sync_engine)
+
+Session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# FastAPI dependency, every request works in its own session
+async def get_session() -> AsyncIterator[AsyncSession]:
+    async with Session() as session:
+        yield session
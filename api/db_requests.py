@@ -1,55 +1,135 @@
+import asyncio
+import functools
+import re
+import time
+import zlib
+from collections import defaultdict
 from datetime import datetime, timedelta
 from os import getenv
-from typing import List
+from typing import (
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+import asyncpg
 
 from fastapi import HTTPException
 from loguru import logger
 from sqlalchemy import (
     BigInteger,
+    Boolean,
     Column,
     DateTime,
     Enum,
+    Index,
     Integer,
+    MetaData,
+    Sequence,
     String,
+    Table,
     and_,
-    create_engine,
+    any_,
+    case,
+    cast,
+    delete,
+    exists,
+    func,
+    literal,
+    or_,
+    select,
+    text,
+    true,
+    tuple_,
+    union,
+    update,
 )
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.engine import Row
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import Select
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import backref, relationship, sessionmaker
-from sqlalchemy.orm.session import Session
-
-from config import (
-    DATABASE_HOST,
-    DATABASE_PORT,
-    POSTGRES_DB,
-    POSTGRES_PASSWORD,
-    POSTGRES_USER,
-    STRING_SIZE,
-)
+from sqlalchemy.orm import aliased, backref, relationship
+from sqlalchemy.schema import CreateTable
+
+from config import STRING_SIZE, UNIT_LOCKS_MAX, WRITE_RETRIES
+from database import Session, engine
 from models import (
-    SystemItem,
     SystemItemHistoryResponse,
     SystemItemHistoryUnit,
     SystemItemImport,
     SystemItemImportRequest,
     SystemItemType,
 )
-from utils import time_to_str
-
-engine = create_engine(
-    f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{POSTGRES_DB}"
-)
+from utils import to_utc
+from validation import ValidationFailed, check_batch
 
 Base = declarative_base()
 
+# every write to a unit takes a new number, see Unit.version
+unit_version_seq = Sequence("unit_version_seq")
+
+# notified on every commit that appends to the change log
+CHANGES_CHANNEL = "unit_changes"
+
+# advisory lock key of history partition creation
+HISTORY_PARTITION_LOCK = 1
+
+# Advisory lock key taken by every write, shared by writes that lock the
+# units they touch and exclusive by bulk imports and writes of too many
+# units, which lock everything.
+# Unit locks are two-key advisory locks of UNIT_LOCK_CLASS, see lockUnits.
+WRITE_LOCK = 2
+UNIT_LOCK_CLASS = 1
+
+DEADLOCK_DETECTED = "40P01"
+# check_violation, raised for a row that fits no history partition
+NO_PARTITION = "23514"
+RETRIED = (DEADLOCK_DETECTED, NO_PARTITION)
+
+# names of history partitions known to exist, per worker
+historyPartitions = set()
+
+# upper bound of history_legacy as shown by pg_get_expr
+LEGACY_BOUND = re.compile(r"TO \('([^']+)'\)")
+
+# asyncpg takes at most 32767 parameters a statement
+MAX_PARAMETERS = 32767
+
+
+# Rows of a multi-row VALUES in parts that fit into the parameters of one
+# statement, `width` is the number of parameters of a row.
+def chunked(rows: List, width: int) -> Iterator[List]:
+    size = MAX_PARAMETERS // width
+    for start in range(0, len(rows), size):
+        yield rows[start : start + size]
+
+
+# Condition of the column being one of the ids, passed as one array
+# parameter: IN of a list takes a parameter per id, more than asyncpg
+# takes for large writes. A select of ids is used as it is.
+def anyOf(column, ids: Iterable[str] | Select):
+    if isinstance(ids, Select):
+        return column.in_(ids)
+    return column == any_(cast(literal(list(ids), ARRAY(String)), ARRAY(String)))
+
 
 class Unit(Base):
     __tablename__ = "unit"
+    __table_args__ = (
+        Index("ix_unit_parentId", "parentId"),
+        Index("ix_unit_type_date_id", "type", "date", "id"),
+    )
     id = Column(
         String(length=STRING_SIZE),
         primary_key=True,
         nullable=False,
-        unique=True,
         autoincrement=False,
     )
     url = Column(String(length=STRING_SIZE), nullable=True)
@@ -57,283 +137,1025 @@ class Unit(Base):
     parentId = Column(String(length=STRING_SIZE), nullable=True)
     type = Column(Enum(SystemItemType))
     size = Column(BigInteger, nullable=True)
+    # Changed whenever the unit or anything in its subtree changes, so it
+    # identifies the state of the whole /nodes response. Numbers come from
+    # a sequence and never repeat, even for a deleted and re-created id.
+    version = Column(
+        BigInteger,
+        unit_version_seq,
+        server_default=unit_version_seq.next_value(),
+        nullable=True,
+    )
 
 
+# Partitioned by month of date into history_YYYY_MM tables, see
+# ensureHistoryPartition, states from before the partitioning are in
+# history_legacy. The primary key includes the partition key.
 class History(Base):
     __tablename__ = "history"
-    id = Column(Integer, primary_key=True, autoincrement=True, nullable=False)
-    unit_id = Column(String(length=STRING_SIZE))
+    __table_args__ = (
+        Index("ix_history_parentId_date", "parentId", "date"),
+        {"postgresql_partition_by": "RANGE (date)"},
+    )
+    unit_id = Column(String(length=STRING_SIZE), primary_key=True)
     url = Column(String(length=STRING_SIZE), nullable=True)
-    date = Column(DateTime)
+    date = Column(DateTime, primary_key=True)
     parentId = Column(String(length=STRING_SIZE), nullable=True)
     type = Column(Enum(SystemItemType))
     size = Column(BigInteger, nullable=True)
 
 
-Base.metadata.create_all(engine)
-Session = sessionmaker()
-Session.configure(bind=engine)
-session = Session()
+# closure table of the units hierarchy, every unit is its own ancestor at depth 0
+class UnitTree(Base):
+    __tablename__ = "unit_tree"
+    __table_args__ = (
+        Index(
+            "ix_unit_tree_ancestor_id_depth", "ancestor_id", "depth", "descendant_id"
+        ),
+    )
+    ancestor_id = Column(String(length=STRING_SIZE), primary_key=True)
+    descendant_id = Column(String(length=STRING_SIZE), primary_key=True, index=True)
+    depth = Column(Integer, nullable=False)
 
 
-def updateParentDate(parentId: str, date: datetime):
-    if parentId is None:
-        return
-    parent = session.query(Unit).get(parentId)
-    last_parent = parent
-    while parent is not None and parent.parentId is not None:
-        session.query(Unit).filter(Unit.id == parent.id).update({Unit.date: date})
-        session.commit()
-        last_parent = parent
-        parent = session.query(Unit).get(parent.parentId)
-    return last_parent
+# Units changed or deleted by committed writes, read in log order under
+# lockChangeLog. A deleted row stands for the unit with its whole subtree.
+# Rows carry only ids, the current state of a unit is read from the unit
+# table.
+class ChangeLog(Base):
+    __tablename__ = "change_log"
+    seq = Column(BigInteger, primary_key=True, autoincrement=True)
+    unit_id = Column(String(length=STRING_SIZE), nullable=False)
+    deleted = Column(Boolean, nullable=False)
+
 
+# Temporary tables of a bulk import: created in its transaction, dropped at
+# the commit and not a part of the schema (Base.metadata).
+bulk_metadata = MetaData()
 
-def addUnit(unit: SystemItemImport, date: datetime):
-    newUnit = Unit(
-        id=unit.id,
-        url=unit.url,
-        date=date,
-        parentId=unit.parentId,
-        type=unit.type,
-        size=unit.size,
+# imported items, type is cast to the enum when merged
+BulkStaging = Table(
+    "bulk_staging",
+    bulk_metadata,
+    Column("id", String(length=STRING_SIZE), primary_key=True),
+    Column("url", String(length=STRING_SIZE)),
+    Column("parentId", String(length=STRING_SIZE)),
+    Column("type", String(length=8), nullable=False),
+    Column("size", BigInteger),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+# units whose closure rows are rebuilt
+BulkNodes = Table(
+    "bulk_nodes",
+    bulk_metadata,
+    Column("id", String(length=STRING_SIZE), primary_key=True),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+# imported units and folders on their chains before and after the import
+BulkTouched = Table(
+    "bulk_touched",
+    bulk_metadata,
+    Column("id", String(length=STRING_SIZE), primary_key=True),
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+
+# rebuild closure rows of units with given ids and all their descendants
+async def updateHierarchy(session: AsyncSession, ids: List[str]) -> None:
+    nodes = set(ids)
+    result = await session.execute(
+        select(UnitTree.descendant_id).where(anyOf(UnitTree.ancestor_id, ids))
     )
-    session.add(newUnit)
-    session.commit()
+    nodes.update(result.scalars())
+    await rebuildHierarchy(session, nodes)
+
 
+# Replace closure rows of the nodes by walking their parentId chains. Nodes
+# are ids or a select of ids, and must include descendants of moved units.
+async def rebuildHierarchy(
+    session: AsyncSession, nodes: Iterable[str] | Select
+) -> None:
+    await session.execute(
+        delete(UnitTree)
+        .where(anyOf(UnitTree.descendant_id, nodes))
+        .execution_options(synchronize_session=False)
+    )
+    chain = select(
+        Unit.id.label("descendant_id"),
+        Unit.id.label("ancestor_id"),
+        Unit.parentId.label("parent_id"),
+        literal(0).label("depth"),
+    ).where(anyOf(Unit.id, nodes))
+    chain = chain.cte(name="chain", recursive=True)
+    chain = chain.union_all(
+        select(
+            chain.c.descendant_id,
+            Unit.id,
+            Unit.parentId,
+            chain.c.depth + 1,
+        ).join(Unit, Unit.id == chain.c.parent_id)
+    )
+    await session.execute(
+        insert(UnitTree).from_select(
+            ["ancestor_id", "descendant_id", "depth"],
+            select(chain.c.ancestor_id, chain.c.descendant_id, chain.c.depth),
+        )
+    )
+
+
+# Apply size deltas and date to every folder on the chains starting at
+# given parents. Deltas are added in the database, rows are locked in id
+# order first, so writes sharing ancestors wait for each other and never
+# lose a size update or deadlock.
+async def updateParents(
+    session: AsyncSession,
+    deltas: Dict[str, int],
+    date: datetime,
+    touched: Set[str],
+) -> None:
+    if not deltas:
+        return
+    ids = cast(literal(list(deltas), ARRAY(String)), ARRAY(String))
+    sizes = cast(literal(list(deltas.values()), ARRAY(BigInteger)), ARRAY(BigInteger))
+    parents = select(
+        func.unnest(ids).label("id"), func.unnest(sizes).label("delta")
+    ).subquery("parents")
+    sums = (
+        select(UnitTree.ancestor_id, func.sum(parents.c.delta).label("delta"))
+        .join(parents, parents.c.id == UnitTree.descendant_id)
+        .group_by(UnitTree.ancestor_id)
+        .subquery()
+    )
+    locked = await session.execute(
+        select(Unit.id)
+        .where(Unit.id.in_(select(sums.c.ancestor_id)))
+        .order_by(Unit.id)
+        .with_for_update()
+    )
+    touched.update(locked.scalars())
+    await session.execute(
+        update(Unit)
+        .where(Unit.id == sums.c.ancestor_id)
+        .values(
+            size=func.coalesce(Unit.size, 0) + sums.c.delta,
+            date=date,
+            version=unit_version_seq.next_value(),
+        )
+        .execution_options(synchronize_session=False)
+    )
 
-def updateUnit(unit: SystemItemImport, date: datetime):
-    # unit = session.query(Unit).get(unit.id)
 
-    session.query(Unit).filter(Unit.id == unit.id).update(
+# insert or update all imported units, as few statements as asyncpg takes
+async def upsertUnits(
+    session: AsyncSession, items: List[SystemItemImport], date: datetime
+) -> None:
+    rows = [
         {
-            Unit.url: unit.url,
-            Unit.date: date,
-            Unit.parentId: unit.parentId,
-            Unit.type: unit.type,
-            Unit.size: unit.size,
+            "id": item.id,
+            "url": item.url,
+            "date": date,
+            "parentId": item.parentId,
+            "type": item.type,
+            # folder size is the sum of its files, maintained by updateParents
+            "size": item.size if item.type == SystemItemType.FILE else 0,
         }
+        for item in items
+    ]
+    for chunk in chunked(rows, 6):
+        await session.execute(onConflictUpdate(insert(Unit).values(chunk)))
+
+
+# update existing units with all imported fields, a folder keeps its size
+def onConflictUpdate(upsert):
+    return upsert.on_conflict_do_update(
+        index_elements=[Unit.id],
+        set_={
+            Unit.url: upsert.excluded.url,
+            Unit.date: upsert.excluded.date,
+            Unit.parentId: upsert.excluded.parentId,
+            Unit.type: upsert.excluded.type,
+            Unit.size: case(
+                (upsert.excluded.type == SystemItemType.FILE, upsert.excluded.size),
+                else_=Unit.size,
+            ),
+            Unit.version: unit_version_seq.next_value(),
+        },
     )
-    session.commit()
 
 
-def getUnit(id: str) -> Unit:
-    return session.query(Unit).get(id)
+# get version and date of the unit, None if there is no such unit
+async def getUnitVersion(session: AsyncSession, id: str) -> Row | None:
+    result = await session.execute(
+        select(Unit.version, Unit.date).where(Unit.id == id)
+    )
+    return result.first()
 
 
-def unitExist(id: str) -> bool:
-    return getUnit(id) is not None
+# versions of the existing units with given ids
+async def getUnitVersions(
+    session: AsyncSession, ids: Iterable[str]
+) -> Dict[str, int | None]:
+    result = await session.execute(
+        select(Unit.id, Unit.version).where(anyOf(Unit.id, ids))
+    )
+    return dict(result.all())
 
 
-# get all units in folder with id=parent_id
-def get_children(parent_id: str) -> List[Unit]:
-    return session.query(Unit).filter(Unit.parentId == parent_id).all()
+# Get the unit with id and its descendants at most `depth` levels below
+# it, with the numbers of children of the folders at the last level. Both
+# queries read only the returned levels and the next one, by the
+# (ancestor_id, depth) index of closure rows and the parentId index.
+async def getSubtreeLevels(
+    session: AsyncSession, id: str, depth: int
+) -> Tuple[List[Row], Dict[str, int]]:
+    result = await session.execute(
+        select(Unit.id, Unit.url, Unit.date, Unit.parentId, Unit.type, Unit.size)
+        .join(UnitTree, UnitTree.descendant_id == Unit.id)
+        .where(and_(UnitTree.ancestor_id == id, UnitTree.depth <= depth))
+    )
+    units = result.all()
+    lastLevel = select(UnitTree.descendant_id).where(
+        and_(UnitTree.ancestor_id == id, UnitTree.depth == depth)
+    )
+    result = await session.execute(
+        select(Unit.parentId, func.count())
+        .where(Unit.parentId.in_(lastLevel))
+        .group_by(Unit.parentId)
+    )
+    return units, dict(result.all())
 
 
-def getUnitInfo(id: str) -> SystemItem:
-    unit = getUnit(id)
-    if unit.type == SystemItemType.FOLDER:
-        children = get_children(id)
-        return SystemItem(
-            id=unit.id,
-            url=unit.url,
-            date=time_to_str(unit.date),
-            parentId=unit.parentId,
-            type=unit.type,
-            children=[getUnitInfo(item.id) for item in children],
-            size=unit.size,
+# get units with given ids and all their descendants, every unit once
+# however many of the subtrees contain it
+async def getSubtrees(session: AsyncSession, ids: Iterable[str]) -> List[Row]:
+    result = await session.execute(
+        select(
+            Unit.id, Unit.url, Unit.date, Unit.parentId, Unit.type, Unit.size
+        ).where(
+            Unit.id.in_(
+                select(UnitTree.descendant_id).where(UnitTree.ancestor_id.in_(ids))
+            )
         )
-    else:
-        return SystemItem(
-            id=unit.id,
-            url=unit.url,
-            date=time_to_str(unit.date),
-            parentId=unit.parentId,
-            type=unit.type,
-            size=unit.size,
+    )
+    return result.all()
+
+
+# get unit with id and all its descendants
+async def getSubtree(session: AsyncSession, id: str) -> List[Row]:
+    result = await session.execute(
+        select(Unit.id, Unit.url, Unit.date, Unit.parentId, Unit.type, Unit.size)
+        .join(UnitTree, UnitTree.descendant_id == Unit.id)
+        .where(UnitTree.ancestor_id == id)
+    )
+    return result.all()
+
+
+# latest state of the unit at or before the date
+def stateAt(unit_id, date: datetime) -> Select:
+    return (
+        select(
+            History.unit_id.label("id"),
+            History.url,
+            History.date,
+            History.parentId,
+            History.type,
+            History.size,
         )
+        .where(and_(History.unit_id == unit_id, History.date <= date))
+        .order_by(History.date.desc())
+        .limit(1)
+    )
 
 
-def getUnitInfoSized(unit_info: SystemItem) -> SystemItem:
-    if not unit_info.children:
-        return unit_info
-    unit_info.size = sum(
-        item.size if item.type == SystemItemType.FILE else getUnitInfoSized(item).size
-        for item in unit_info.children
+# Get the unit with id and its descendants as they were at the date, from
+# their latest states at or before it. One recursive query: children of a
+# folder are the units that had it as a parent before the date, found by
+# the ("parentId", date) index, and still have it in their latest state.
+# Deleted units have no history, so they are missing from the tree.
+async def getSubtreeAt(session: AsyncSession, id: str, date: datetime) -> List[Row]:
+    date = to_utc(date)
+    root = stateAt(id, date).subquery()
+    tree = select(root).cte(name="tree", recursive=True)
+    candidates = (
+        select(History.unit_id)
+        .where(and_(History.parentId == tree.c.id, History.date <= date))
+        .distinct()
+        .lateral("candidate")
     )
-    return unit_info
+    state = stateAt(candidates.c.unit_id, date).lateral("state")
+    tree = tree.union_all(
+        select(state)
+        .select_from(tree)
+        .join(candidates, true())
+        .join(state, true())
+        .where(
+            and_(tree.c.type == SystemItemType.FOLDER, state.c.parentId == tree.c.id)
+        )
+    )
+    return (await session.execute(select(tree))).all()
+
 
+# root folders with the largest sizes, with their versions
+async def getLargestRoots(session: AsyncSession, limit: int) -> List[Row]:
+    result = await session.execute(
+        select(Unit.id, Unit.version)
+        .where(
+            and_(Unit.parentId.is_(None), Unit.type == SystemItemType.FOLDER)
+        )
+        .order_by(Unit.size.desc())
+        .limit(limit)
+    )
+    return result.all()
 
-def getNode(id: str) -> SystemItem:
-    return getUnitInfoSized(getUnitInfo(id))
 
+# Run the hot statements once with an id that matches nothing, so the
+# connection has them prepared before the first request comes.
+async def prepareStatements(session: AsyncSession) -> None:
+    await getUnitVersion(session, "")
+    await getSubtree(session, "")
+    await getSubtreeAt(session, "", datetime.utcnow())
+    await getUpdates(session, datetime.utcnow(), 1)
+    await getNodeHistory(session, "", None, None, 1)
+    await getReferenced(session, [""])
 
-def getUnits():
-    return session.query(Unit).all()
 
+# open `connections` pooled connections at once and prepare statements on each
+async def warmUpPool(connections: int) -> None:
+    async def warmUp() -> None:
+        async with Session() as session:
+            await prepareStatements(session)
 
-def deleteUnits():
-    session.query(Unit).delete()
-    session.query(History).delete()
-    session.commit()
+    await asyncio.gather(*(warmUp() for _ in range(connections)))
 
 
-def getHistory():
-    return session.query(History).all()
+async def ping(session: AsyncSession) -> None:
+    await session.execute(select(1))
 
 
-def getUpdates(date: datetime):
+async def getUnits(session: AsyncSession):
+    return (await session.execute(select(Unit))).scalars().all()
+
+
+async def deleteUnits(session: AsyncSession):
+    roots = await session.execute(select(Unit.id).where(Unit.parentId.is_(None)))
+    await logChanges(session, [], roots.scalars().all())
+    await session.execute(delete(Unit))
+    await session.execute(delete(UnitTree))
+    await session.execute(delete(History))
+    await session.commit()
+
+
+async def getHistory(session: AsyncSession):
+    return (await session.execute(select(History))).scalars().all()
+
+
+# files updated in [date - 24h, date] in keyset order
+def updatesQuery(date: datetime):
+    date = to_utc(date)
     day_ago = date - timedelta(days=1)
-    updated = (
-        session.query(Unit)
-        .filter(
+    return (
+        select(Unit.id, Unit.url, Unit.parentId, Unit.type, Unit.size, Unit.date)
+        .where(
             and_(
                 day_ago <= Unit.date,
                 Unit.date <= date,
                 Unit.type == SystemItemType.FILE,
             )
         )
-        .all()
-    )
-    return SystemItemHistoryResponse(
-        items=[
-            SystemItemHistoryUnit(
-                id=item.id,
-                url=item.url,
-                parentId=item.parentId,
-                type=item.type,
-                size=item.size,
-                date=item.date,
-            )
-            for item in updated
-        ]
+        .order_by(Unit.date, Unit.id)
     )
 
 
-def getNodeHistory(
-    id: str,
-    date_start: datetime | None,
-    date_end: datetime | None,
-) -> SystemItemHistoryResponse:
-    if date_start is None:
-        nodeHistory = (
-            session.query(History)
-            .filter(
-                History.unit_id == id,
+# get one page of updates after the (date, id) key, with the key of the
+# last returned item if there may be more
+async def getUpdates(
+    session: AsyncSession,
+    date: datetime,
+    limit: int,
+    after: Tuple[datetime, str] | None = None,
+) -> Tuple[SystemItemHistoryResponse, Tuple[datetime, str] | None]:
+    query = updatesQuery(date)
+    if after is not None:
+        query = query.where(tuple_(Unit.date, Unit.id) > tuple_(*after))
+    updated = (await session.execute(query.limit(limit))).all()
+    last = (updated[-1].date, updated[-1].id) if len(updated) == limit else None
+    return (
+        SystemItemHistoryResponse(
+            items=[
+                SystemItemHistoryUnit(
+                    id=item.id,
+                    url=item.url,
+                    parentId=item.parentId,
+                    type=item.type,
+                    size=item.size,
+                    date=item.date,
+                )
+                for item in updated
+            ]
+        ),
+        last,
+    )
+
+
+# get all updates through a server-side cursor, batch_size rows at a time
+async def streamUpdates(
+    session: AsyncSession, date: datetime, batch_size: int
+) -> AsyncIterator[List[Row]]:
+    result = await session.stream(updatesQuery(date))
+    async for rows in result.partitions(batch_size):
+        yield rows
+
+
+# states of the unit in [date_start, date_end) or all of them, by date
+def nodeHistoryQuery(
+    id: str, date_start: datetime | None, date_end: datetime | None
+) -> Select:
+    query = select(
+        History.unit_id.label("id"),
+        History.url,
+        History.parentId,
+        History.type,
+        History.date,
+        History.size,
+    ).where(History.unit_id == id)
+    if date_start is not None:
+        query = query.where(
+            and_(
+                to_utc(date_start) <= History.date,
+                History.date < to_utc(date_end),
             )
-            .all()
         )
+    return query
+
 
+# Get history of the unit ordered by date: a page after the `after` date,
+# with the date of the last returned state if there may be more, or only
+# the `latest` states. Both are range scans of the (unit_id, date) index.
+async def getNodeHistory(
+    session: AsyncSession,
+    id: str,
+    date_start: datetime | None,
+    date_end: datetime | None,
+    limit: int,
+    after: datetime | None = None,
+    latest: int | None = None,
+) -> Tuple[SystemItemHistoryResponse, datetime | None]:
+    query = nodeHistoryQuery(id, date_start, date_end)
+    last = None
+    if latest is not None:
+        query = query.order_by(History.date.desc()).limit(latest)
+        nodeHistory = (await session.execute(query)).all()
+        nodeHistory.reverse()
     else:
-        nodeHistory = (
-            session.query(History)
-            .filter(
-                and_(
-                    History.unit_id == id,
-                    date_start <= History.date,
-                    History.date < date_end,
+        if after is not None:
+            query = query.where(History.date > after)
+        query = query.order_by(History.date).limit(limit)
+        nodeHistory = (await session.execute(query)).all()
+        if len(nodeHistory) == limit:
+            last = nodeHistory[-1].date
+    return (
+        SystemItemHistoryResponse(
+            items=[
+                SystemItemHistoryUnit(
+                    id=item.id,
+                    url=item.url,
+                    parentId=item.parentId,
+                    type=item.type,
+                    date=item.date,
+                    size=item.size,
                 )
-            )
-            .all()
+                for item in nodeHistory
+            ]
+        ),
+        last,
+    )
+
+
+# get all history of the unit through a server-side cursor, see streamUpdates
+async def streamNodeHistory(
+    session: AsyncSession,
+    id: str,
+    date_start: datetime | None,
+    date_end: datetime | None,
+    batch_size: int,
+) -> AsyncIterator[List[Row]]:
+    query = nodeHistoryQuery(id, date_start, date_end).order_by(History.date)
+    result = await session.stream(query)
+    async for rows in result.partitions(batch_size):
+        yield rows
+
+
+# save current state of units with given ids, one state per unit and date
+async def dumpUnits(session: AsyncSession, ids: Iterable[str]) -> None:
+    await session.flush()
+    snapshot = select(
+        Unit.id, Unit.url, Unit.date, Unit.parentId, Unit.type, Unit.size
+    ).where(anyOf(Unit.id, ids))
+    dump = insert(History).from_select(
+        ["unit_id", "url", "date", "parentId", "type", "size"], snapshot
+    )
+    await session.execute(
+        dump.on_conflict_do_update(
+            index_elements=[History.unit_id, History.date],
+            set_={
+                History.url: dump.excluded.url,
+                History.parentId: dump.excluded.parentId,
+                History.type: dump.excluded.type,
+                History.size: dump.excluded.size,
+            },
         )
-    return SystemItemHistoryResponse(
-        items=[
-            SystemItemHistoryUnit(
-                id=item.unit_id,
-                url=item.url,
-                parentId=item.parentId,
-                type=item.type,
-                date=item.date,
-                size=item.size,
+    )
+
+
+# Append changed and deleted units to the change log and notify listeners,
+# must be the last statement before the commit. Writers do not wait for
+# each other here, so log numbers may commit out of order; readers take
+# lockChangeLog first. Changed ids may also be given as a select of ids.
+async def logChanges(
+    session: AsyncSession, ids: Iterable[str] | Select, deleted: Iterable[str] = ()
+) -> None:
+    rows = [{"unit_id": id, "deleted": True} for id in deleted]
+    if isinstance(ids, Select):
+        changed = ids.subquery()
+        statements = [
+            insert(ChangeLog).from_select(
+                ["unit_id", "deleted"],
+                select(changed.c[0], literal(False)),
             )
-            for item in nodeHistory
         ]
+    else:
+        rows += [{"unit_id": id, "deleted": False} for id in ids]
+        statements = []
+    statements[:0] = [insert(ChangeLog).values(chunk) for chunk in chunked(rows, 2)]
+    if not statements:
+        return
+    for statement in statements:
+        await session.execute(statement)
+    await session.execute(select(func.pg_notify(CHANGES_CHANNEL, "")))
+
+
+# Wait for the writes that have appended to the change log to commit, and
+# keep new ones from appending until the end of the transaction. Appending
+# is the last statement of a write, so the wait is only for its commit.
+# Afterwards every log number up to the last one is final: a reader that
+# has seen a number will never see a smaller one appear.
+async def lockChangeLog(session: AsyncSession) -> None:
+    await session.execute(text("LOCK TABLE change_log IN SHARE MODE"))
+
+
+# number of the last change, with every change before it committed
+async def lastChange(session: AsyncSession) -> int:
+    await lockChangeLog(session)
+    result = await session.execute(select(func.coalesce(func.max(ChangeLog.seq), 0)))
+    return result.scalar_one()
+
+
+# number of the oldest change kept in the log, None if the log is empty
+async def firstChange(session: AsyncSession) -> int | None:
+    result = await session.execute(select(func.min(ChangeLog.seq)))
+    return result.scalar_one()
+
+
+# all units with the columns kept by the in-memory tree, batch_size rows at a time
+async def streamTree(
+    session: AsyncSession, batch_size: int
+) -> AsyncIterator[List[Row]]:
+    result = await session.stream(
+        select(
+            Unit.id,
+            Unit.url,
+            Unit.date,
+            Unit.parentId,
+            Unit.type,
+            Unit.size,
+            Unit.version,
+        )
     )
+    async for rows in result.partitions(batch_size):
+        yield rows
 
 
-def dumpSystemItem(item: SystemItem) -> None:
-    dump = History(
-        unit_id=item.id,
-        url=item.url,
-        parentId=item.parentId,
-        type=item.type,
-        date=item.date,
-        size=item.size,
+# Get changes after the `after` number with the current state of changed
+# units, whose columns are null if the unit does not exist any more. No
+# change before the returned ones can commit later, see lockChangeLog.
+async def getChanges(session: AsyncSession, after: int, limit: int) -> List[Row]:
+    await lockChangeLog(session)
+    result = await session.execute(
+        select(
+            ChangeLog.seq,
+            ChangeLog.unit_id,
+            ChangeLog.deleted,
+            Unit.id,
+            Unit.url,
+            Unit.date,
+            Unit.parentId,
+            Unit.type,
+            Unit.size,
+            Unit.version,
+        )
+        .outerjoin(Unit, Unit.id == ChangeLog.unit_id)
+        .where(ChangeLog.seq > after)
+        .order_by(ChangeLog.seq)
+        .limit(limit)
     )
-    if (
-        session.query(History)
-        .filter(
-            and_(
-                History.unit_id == dump.unit_id,
-                History.date == dump.date,
-                History.url == dump.url,
-                History.parentId == dump.parentId,
-                History.type == dump.type,
-                History.size == dump.size,
+    return result.all()
+
+
+# name and bounds of the monthly history partition holding the date
+def historyPartition(date: datetime) -> Tuple[str, datetime, datetime]:
+    start = datetime(date.year, date.month, 1)
+    end = datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+    return f"history_{start:%Y_%m}", start, end
+
+
+# End of the dates held by history_legacy, the history from before the
+# partitioning, or None once it has been dropped. See migration 0006.
+async def historyLegacyEnd(connection: AsyncConnection) -> Optional[datetime]:
+    bound = await connection.execute(
+        text(
+            "SELECT pg_get_expr(relpartbound, oid) FROM pg_class "
+            "WHERE oid = to_regclass('history_legacy')"
+        )
+    )
+    match = LEGACY_BOUND.search(bound.scalar() or "")
+    return datetime.fromisoformat(match.group(1)) if match else None
+
+
+# Create the history partition for the month of the date if it is missing.
+# This runs in a short transaction of its own before a write, since
+# creating a partition locks the whole history table until the commit.
+# Months before the end of history_legacy are held by it.
+async def ensureHistoryPartition(date: datetime) -> None:
+    name, start, end = historyPartition(date)
+    if name in historyPartitions:
+        return
+    async with engine.begin() as connection:
+        legacyEnd = await historyLegacyEnd(connection)
+        if legacyEnd is not None and start < legacyEnd:
+            historyPartitions.add(name)
+            return
+        exists = await connection.execute(select(func.to_regclass(name)))
+        if exists.scalar() is None:
+            await connection.execute(
+                select(func.pg_advisory_xact_lock(HISTORY_PARTITION_LOCK))
+            )
+            await connection.execute(
+                text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF history "
+                    f"FOR VALUES FROM ('{start}') TO ('{end}')"
+                )
             )
+    historyPartitions.add(name)
+
+
+# Existing units with given ids and all their ancestors, in one query.
+# The walk up the parentId chains visits every unit once however many
+# chains share it, closure rows would repeat the ancestors of deep trees.
+async def getReferenced(session: AsyncSession, ids: List[str]) -> List[Row]:
+    chain = select(Unit.id, Unit.parentId, Unit.type, Unit.size).where(
+        anyOf(Unit.id, ids)
+    )
+    chain = chain.cte(name="chain", recursive=True)
+    chain = chain.union(
+        select(Unit.id, Unit.parentId, Unit.type, Unit.size).join(
+            chain, Unit.id == chain.c.parentId
         )
-        .first()
-        is None
-    ):
-        session.add(dump)
-        session.commit()
+    )
+    return (await session.execute(select(chain))).all()
 
 
-def dumpEndParent(end_parent_id):
-    def recDumpChilds(unit: SystemItem):
-        dumpSystemItem(unit)
-        for item in unit.children or []:
-            recDumpChilds(item)
+# advisory lock key of a unit id, the same in every process
+def unitLockKey(id: str) -> int:
+    key = zlib.crc32(id.encode())
+    return key - (1 << 32) if key >= 1 << 31 else key
 
-    node = getNode(end_parent_id)
-    recDumpChilds(node)
 
+# Take the write lock in shared mode, then the locks of written units in
+# exclusive and of units on their chains in shared mode. A write to a
+# unit excludes writes to its subtree and to its ancestors' ids, writes
+# to disjoint subtrees run in parallel. Keys are locked in sorted order,
+# so writes never wait for each other in a cycle.
+async def lockUnits(
+    session: AsyncSession, exclusive: Iterable[str], shared: Iterable[str]
+) -> None:
+    modes: Dict[int, bool] = {}
+    for id in shared:
+        modes[unitLockKey(id)] = False
+    for id in exclusive:
+        modes[unitLockKey(id)] = True
+    keys = sorted(modes)
+    await session.execute(select(func.pg_advisory_xact_lock_shared(WRITE_LOCK)))
+    await session.execute(
+        text(
+            "SELECT CASE WHEN l.exclusive "
+            "THEN pg_advisory_xact_lock(:class, l.key) "
+            "ELSE pg_advisory_xact_lock_shared(:class, l.key) END "
+            "FROM unnest(CAST(:keys AS integer[]), CAST(:modes AS boolean[])) "
+            "AS l(key, exclusive) ORDER BY l.key"
+        ),
+        {"class": UNIT_LOCK_CLASS, "keys": keys, "modes": [modes[key] for key in keys]},
+    )
 
-def dumpAll():
-    parents = session.query(Unit).filter(Unit.parentId == None).all()
-    for parent in parents:
-        dumpEndParent(parent.id)
 
+# Lock units with given ids and the chains of their parents, and return
+# the existing ones with all their ancestors, read under the locks. When
+# a write committed in between has changed the chains, the missing locks
+# are taken and the units are read again. Writes of more than
+# UNIT_LOCKS_MAX units lock out all other writes instead.
+async def lockReferenced(
+    session: AsyncSession, ids: List[str], parentIds: List[str]
+) -> List[Row]:
+    written = set(ids)
+    locked: Set[str] = set()
+    while True:
+        referenced = await getReferenced(session, ids + parentIds)
+        missing = ({unit.id for unit in referenced} | written | set(parentIds)) - locked
+        if not missing:
+            return referenced
+        if len(locked) + len(missing) > UNIT_LOCKS_MAX:
+            # no other write runs until the commit, the units read are final
+            await session.execute(select(func.pg_advisory_xact_lock(WRITE_LOCK)))
+            return await getReferenced(session, ids + parentIds)
+        await lockUnits(session, missing & written, missing - written)
+        locked |= missing
 
-def deleteUnit(id: str, date: datetime):
-    parentId = session.query(Unit).get(id).parentId
 
-    def onlyDelete(id: str):
-        unit = session.query(Unit).get(id)
-        if unit.type == SystemItemType.FOLDER:
-            for child in get_children(unit.id):
-                onlyDelete(child.id)
-        # delete all history
-        session.query(History).filter(History.unit_id == id).delete()
-        session.commit()
-        # delete unit
-        session.query(Unit).filter(Unit.id == id).delete()
-        session.commit()
+# Run the write again from the start when the database aborts it to break
+# a deadlock, or when the history partition it writes to has been dropped
+# by maintenance.py since it was cached in historyPartitions. The session
+# is rolled back before every new attempt.
+def retryWrite(write):
+    @functools.wraps(write)
+    async def retried(session: AsyncSession, *args):
+        for attempt in range(1, WRITE_RETRIES + 1):
+            try:
+                return await write(session, *args)
+            except DBAPIError as e:
+                sqlstate = getattr(e.orig, "sqlstate", None)
+                if sqlstate not in RETRIED or attempt == WRITE_RETRIES:
+                    raise
+                await session.rollback()
+                if sqlstate == NO_PARTITION:
+                    historyPartitions.clear()
+                logger.warning(f"{write.__name__}: {sqlstate}, attempt {attempt}")
 
-    onlyDelete(id)
-    updateSizes(date)
-    dumpAll()
+    return retried
 
 
-def updateSizes(date: datetime):
-    parents = session.query(Unit).filter(Unit.parentId == None).all()
+# Delete the unit with its subtree, False if there is no such unit. The
+# unit is locked with its ancestors, it may be gone once the lock is taken.
+@retryWrite
+async def deleteUnit(session: AsyncSession, id: str, date: datetime) -> bool:
+    date = to_utc(date)
+    await ensureHistoryPartition(date)
+    referenced = {unit.id: unit for unit in await lockReferenced(session, [id], [])}
+    if id not in referenced:
+        await session.rollback()
+        return False
+    parentId, size = referenced[id].parentId, referenced[id].size or 0
 
-    def recUpdateUnit(unit: SystemItem):
-        current_item = getUnit(unit.id)
-        if current_item.size != unit.size:
-            updateUnit(unit, date)
-        for item in unit.children or []:
-            recUpdateUnit(item)
+    # remove the whole subtree with its history, closure rows go last
+    # since the subtree is selected from them
+    subtree = select(UnitTree.descendant_id).where(UnitTree.ancestor_id == id)
+    for statement in (
+        delete(History).where(History.unit_id.in_(subtree)),
+        delete(Unit).where(Unit.id.in_(subtree)),
+        delete(UnitTree).where(UnitTree.descendant_id.in_(subtree)),
+    ):
+        await session.execute(
+            statement.execution_options(synchronize_session=False)
+        )
 
-    for parent in parents:
-        recUpdateUnit(getNode(parent.id))
-    dumpAll()
+    touched: Set[str] = set()
+    if parentId is not None:
+        await updateParents(session, {parentId: -size}, date, touched)
+    await dumpUnits(session, touched)
+    await logChanges(session, touched, [id])
+    await session.commit()
+    return True
 
 
-def importItems(imported: SystemItemImportRequest):
-    for item in imported.items:
-        if unitExist(item.id):
-            updateUnit(item, imported.updateDate)
+@retryWrite
+async def importItems(session: AsyncSession, imported: SystemItemImportRequest):
+    if not imported.items:
+        return
+    date = to_utc(imported.updateDate)
+    await ensureHistoryPartition(date)
+    ids = [item.id for item in imported.items]
+    referenced = await lockReferenced(
+        session, ids, [item.parentId for item in imported.items if item.parentId]
+    )
+    items = check_batch(
+        imported.items,
+        {unit.id: (unit.type, unit.parentId) for unit in referenced},
+    )
+    importedIds = set(ids)
+    old = {
+        unit.id: (unit.parentId, unit.size or 0)
+        for unit in referenced
+        if unit.id in importedIds
+    }
+    await upsertUnits(session, items, date)
+    result = await session.execute(select(Unit).where(anyOf(Unit.id, ids)))
+    units = result.scalars().all()
+    touched = set(ids)
+
+    await updateHierarchy(
+        session,
+        [
+            unit.id
+            for unit in units
+            if unit.id not in old or old[unit.id][0] != unit.parentId
+        ],
+    )
+
+    # Sizes are propagated only along the ancestor chains of imported items.
+    # Chains are walked in the new hierarchy; a folder carries its size
+    # from before the import, its imported children add their own deltas.
+    deltas: Dict[str, int] = defaultdict(int)
+    for unit in units:
+        oldParentId, oldSize = old.get(unit.id, (None, 0))
+        newSize = unit.size if unit.type == SystemItemType.FILE else oldSize
+        if oldParentId == unit.parentId:
+            deltas[unit.parentId] += newSize - oldSize
         else:
-            addUnit(item, imported.updateDate)
-    updateSizes(imported.updateDate)
+            deltas[oldParentId] -= oldSize
+            deltas[unit.parentId] += newSize
+    deltas.pop(None, None)
+    await updateParents(session, deltas, date, touched)
+
+    # nothing is written until this commit, the session rolls back on errors
+    await dumpUnits(session, touched)
+    await logChanges(session, touched)
+    await session.commit()
+
+
+# copy a batch of imported items to the staging table of a bulk import
+async def stageItems(session: AsyncSession, items: List[SystemItemImport]) -> None:
+    connection = await (await session.connection()).get_raw_connection()
+    try:
+        await connection.driver_connection.copy_records_to_table(
+            BulkStaging.name,
+            records=[
+                (item.id, item.url, item.parentId, item.type.value, item.size)
+                for item in items
+            ],
+            columns=[column.name for column in BulkStaging.columns],
+        )
+    except asyncpg.UniqueViolationError:
+        raise ValidationFailed("duplicate id in bulk import")
+
+
+# Refresh planner statistics in the middle of a bulk import: temporary
+# tables are never analyzed automatically, and a load into an empty disk
+# leaves stale estimates that turn the hierarchy walk into nested loops.
+# ANALYZE in the transaction sees its own uncommitted rows.
+async def analyze(session: AsyncSession, *tables: Table) -> None:
+    for table in tables:
+        await session.execute(text(f"ANALYZE {table.name}"))
+
+
+# staged items may not change types or have parents that are not folders
+async def checkStaged(session: AsyncSession) -> None:
+    parent = aliased(BulkStaging)
+    orphan = select(BulkStaging.c.id).where(
+        BulkStaging.c.parentId.isnot(None),
+        ~exists().where(
+            and_(
+                parent.c.id == BulkStaging.c.parentId,
+                parent.c.type == SystemItemType.FOLDER.value,
+            )
+        ),
+        ~exists().where(
+            and_(
+                Unit.id == BulkStaging.c.parentId,
+                Unit.type == SystemItemType.FOLDER,
+            )
+        ),
+    )
+    retyped = select(BulkStaging.c.id).join(
+        Unit,
+        and_(
+            Unit.id == BulkStaging.c.id,
+            Unit.type != cast(BulkStaging.c.type, Unit.type.type),
+        ),
+    )
+    for query in (orphan, retyped):
+        invalid = (await session.execute(query.limit(1))).scalar()
+        if invalid is not None:
+            raise ValidationFailed(f"invalid parent or type of {invalid}")
+
+
+# Merge staged items into units. Unlike importItems no deltas are tracked:
+# folders on the chains of imported items before and after the import get
+# their sizes summed from files in their subtrees once at the end.
+async def mergeStaged(session: AsyncSession, date: datetime) -> None:
+    staged = select(BulkStaging.c.id)
+    moved = (
+        select(BulkStaging.c.id)
+        .outerjoin(Unit, Unit.id == BulkStaging.c.id)
+        .where(
+            or_(
+                Unit.id.is_(None),
+                Unit.parentId.is_distinct_from(BulkStaging.c.parentId),
+            )
+        )
+    )
+    await session.execute(
+        insert(BulkNodes).from_select(
+            ["id"],
+            union(
+                moved,
+                select(UnitTree.descendant_id).where(UnitTree.ancestor_id.in_(moved)),
+            ),
+        )
+    )
+    chains = select(UnitTree.ancestor_id).where(UnitTree.descendant_id.in_(staged))
+    await session.execute(
+        insert(BulkTouched).from_select(["id"], chains.distinct())
+    )
+
+    upsert = insert(Unit).from_select(
+        ["id", "url", "date", "parentId", "type", "size"],
+        select(
+            BulkStaging.c.id,
+            BulkStaging.c.url,
+            literal(date, DateTime),
+            BulkStaging.c.parentId,
+            cast(BulkStaging.c.type, Unit.type.type),
+            case(
+                (BulkStaging.c.type == SystemItemType.FILE.value, BulkStaging.c.size),
+                else_=0,
+            ),
+        ),
+    )
+    await session.execute(onConflictUpdate(upsert))
+    await analyze(session, Unit.__table__, BulkNodes)
+    await rebuildHierarchy(session, select(BulkNodes.c.id))
+    await session.execute(
+        insert(BulkTouched)
+        .from_select(["id"], chains.distinct())
+        .on_conflict_do_nothing()
+    )
+
+    await analyze(session, UnitTree.__table__, BulkTouched)
+    touched = select(BulkTouched.c.id)
+    file = aliased(Unit)
+    sums = (
+        select(UnitTree.ancestor_id, func.sum(file.size).label("size"))
+        .join(file, file.id == UnitTree.descendant_id)
+        .where(UnitTree.ancestor_id.in_(touched), file.type == SystemItemType.FILE)
+        .group_by(UnitTree.ancestor_id)
+        .subquery()
+    )
+    totals = (
+        select(BulkTouched.c.id, func.coalesce(sums.c.size, 0).label("size"))
+        .outerjoin(sums, sums.c.ancestor_id == BulkTouched.c.id)
+        .subquery()
+    )
+    await session.execute(
+        update(Unit)
+        .where(Unit.id == totals.c.id, Unit.type == SystemItemType.FOLDER)
+        .values(size=totals.c.size, date=date, version=unit_version_seq.next_value())
+        .execution_options(synchronize_session=False)
+    )
+    await dumpUnits(session, touched)
+    await logChanges(session, touched)
+
+
+# Import batches of items in one transaction: a failed check of any item
+# rolls back the whole load. Returns the number of imported items.
+async def bulkImportItems(
+    session: AsyncSession,
+    batches: AsyncIterator[List[SystemItemImport]],
+    date: datetime,
+) -> int:
+    date = to_utc(date)
+    await ensureHistoryPartition(date)
+    for table in bulk_metadata.sorted_tables:
+        await session.execute(CreateTable(table))
+    start = time.perf_counter()
+    count = 0
+    async for items in batches:
+        await stageItems(session, items)
+        count += len(items)
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"bulk import: {count} items staged, {count / elapsed:.0f} items/s"
+        )
+    if count:
+        # staging runs next to other writes, the merge excludes them all
+        await session.execute(select(func.pg_advisory_xact_lock(WRITE_LOCK)))
+        await analyze(session, BulkStaging)
+        await checkStaged(session)
+        await mergeStaged(session, date)
+    await session.commit()
+    logger.info(
+        f"bulk import: {count} items merged in {time.perf_counter() - start:.1f}s"
+    )
+    return count
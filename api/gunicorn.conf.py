@@ -0,0 +1,14 @@
+import os
+import time
+
+from prometheus_client import multiprocess
+
+
+# Start of the cold start of a worker, measured by the app, see STARTED
+def post_fork(server, worker):
+    os.environ["WORKER_STARTED"] = str(time.time())
+
+
+# Drop the live gauges of a worker that exited, its counters stay in the files
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
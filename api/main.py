@@ -1,28 +1,265 @@
+import asyncio
+import time
 from datetime import datetime
+from os import getenv
+from typing import AsyncIterator, Dict, List
 
-from fastapi import FastAPI, Response, status
+from fastapi import Depends, FastAPI, Header, Query, Response, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
+from loguru import logger
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 
-from config import MODE, Mode
+from changes import ChangeFeed
+from config import (
+    BULK_BATCH_SIZE,
+    CHANGES_BUFFER_SIZE,
+    CHANGES_KEEPALIVE_SECONDS,
+    CHANGES_MAX_PAGE_SIZE,
+    CHANGES_MAX_WAIT_SECONDS,
+    CHANGES_PAGE_SIZE,
+    CHANGES_WAIT_SECONDS,
+    HISTORY_MAX_PAGE_SIZE,
+    HISTORY_PAGE_SIZE,
+    MODE,
+    NODE_CACHE_BYTES,
+    NODE_CACHE_PRELOAD,
+    NODE_STREAM_THRESHOLD,
+    NODES_BATCH_SIZE,
+    POOL_WARMUP,
+    SLOW_REQUEST_SECONDS,
+    TREE_ENGINE,
+    UPDATES_MAX_PAGE_SIZE,
+    UPDATES_PAGE_SIZE,
+    WARMUP_RETRY_SECONDS,
+    Mode,
+    TreeMode,
+)
+from database import Session, engine, get_session
 from db_requests import (
+    bulkImportItems,
     deleteUnit,
     deleteUnits,
     getHistory,
+    getLargestRoots,
     getNodeHistory,
-    getUnitInfo,
+    getSubtree,
+    getSubtreeAt,
+    getSubtreeLevels,
+    getSubtrees,
     getUnits,
+    getUnitVersion,
+    getUnitVersions,
     getUpdates,
     importItems,
-    unitExist,
+    ping,
+    streamNodeHistory,
+    streamUpdates,
+    warmUpPool,
+)
+from metrics import (
+    CONTENT_TYPE_LATEST,
+    InstrumentedCache,
+    RequestStats,
+    observe_request,
+    observe_startup,
+    render,
+    request_stats,
 )
 from models import Error, SystemItemImport, SystemItemImportRequest
-from utils import str_to_time, time_to_str
+from serializers import (
+    aiter_history_json,
+    aiter_ndjson_items,
+    dump_change_events,
+    dump_changes_json,
+    dump_nodes_json,
+    dump_tree_json,
+    group_units,
+    iter_node_json,
+    iter_tree_json,
+)
+from tree import TreeEngine
+from utils import (
+    decode_cursor,
+    encode_cursor,
+    etag_matches,
+    make_etag,
+    str_to_time,
+    time_to_str,
+)
+from validation import ValidationFailed
 
 app = FastAPI()
 
+node_cache = InstrumentedCache(NODE_CACHE_BYTES)
+
+tree = TreeEngine() if TREE_ENGINE == TreeMode.MEMORY else None
+
+feed = ChangeFeed(CHANGES_BUFFER_SIZE)
+
+# routes that wait for changes on purpose, never logged as slow
+WAITING_ROUTES = {"/changes", "/changes/stream"}
+
+
+# Cold start of a worker is measured from its fork by gunicorn, see
+# gunicorn.conf.py, or from the import of the app when run without it.
+STARTED = float(getenv("WORKER_STARTED", time.time()))
+
+# seconds of every startup step, "total" is set once the worker is ready
+startup_seconds: Dict[str, float] = {}
+# retries of a warm-up that failed at startup
+warming: asyncio.Task | None = None
+
+
+# The in-memory tree once it is loaded. Until then, while a failed warm-up
+# is retried, trees are read from the database.
+def loaded_tree() -> TreeEngine | None:
+    return tree if tree is not None and tree.loaded else None
+
+
+# cache /nodes trees of the largest root folders
+async def preload_cache(limit: int) -> None:
+    memory = loaded_tree()
+    async with Session() as session:
+        for root in await getLargestRoots(session, limit):
+            if memory is not None:
+                units = memory.index.subtree(memory.index.find(root.id))
+            else:
+                units = await getSubtree(session, root.id)
+            if len(units) <= NODE_STREAM_THRESHOLD:
+                node_cache.put(root.id, root.version, dump_tree_json(units, root.id))
+
+
+# Warm the worker up: open pooled connections with prepared statements,
+# load the in-memory tree and the cache, start the change feed. A retry
+# after a failure skips the steps done, those in startup_seconds.
+async def warm_up() -> None:
+    mark = time.perf_counter()
+
+    def lap(step: str) -> None:
+        nonlocal mark
+        now = time.perf_counter()
+        startup_seconds[step] = now - mark
+        mark = now
+
+    if "pool" not in startup_seconds:
+        await warmUpPool(POOL_WARMUP)
+        lap("pool")
+    if tree is not None and "tree" not in startup_seconds:
+        await tree.start()
+        lap("tree")
+    if NODE_CACHE_PRELOAD and "cache" not in startup_seconds:
+        await preload_cache(NODE_CACHE_PRELOAD)
+        lap("cache")
+    await feed.start()
+    lap("feed")
+    startup_seconds["total"] = time.time() - STARTED
+    observe_startup(startup_seconds)
+    steps = ", ".join(
+        f"{step} {seconds:.2f}s" for step, seconds in startup_seconds.items()
+    )
+    logger.info(f"worker ready: {steps}")
+
+
+async def keep_warming_up() -> None:
+    while True:
+        await asyncio.sleep(WARMUP_RETRY_SECONDS)
+        try:
+            return await warm_up()
+        except (OSError, SQLAlchemyError) as e:
+            logger.warning(f"warm-up failed: {e}")
+
+
+# The worker takes requests once warm. If the database is not up yet, it
+# starts cold and warms up in the background, not ready until then.
+@app.on_event("startup")
+async def start():
+    global warming
+    startup_seconds["import"] = time.time() - STARTED
+    try:
+        await warm_up()
+    except (OSError, SQLAlchemyError) as e:
+        logger.warning(f"warm-up failed, retrying in the background: {e}")
+        warming = asyncio.create_task(keep_warming_up())
+
+
+@app.on_event("shutdown")
+async def stop():
+    if warming is not None:
+        warming.cancel()
+    if tree is not None:
+        await tree.stop()
+    await feed.stop()
+    await engine.dispose()
+
+
+# Route template of a request, so metrics are not labelled by raw ids
+def route_name(scope: Scope) -> str:
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "other"
+
+
+class CollectMetrics:
+    """Metrics of every request, observed once the last chunk is sent.
+
+    Streamed responses are timed to their end, with the SQL run while the
+    body streams. A plain ASGI middleware: @app.middleware("http") hands
+    the response through an unbounded queue and buffers streamed bodies.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+        observed = False
+
+        def observe() -> None:
+            nonlocal observed
+            observed = True
+            elapsed = time.perf_counter() - start
+            route = route_name(scope)
+            observe_request(scope["method"], route, status_code, elapsed, stats)
+            if elapsed > SLOW_REQUEST_SECONDS and route not in WAITING_ROUTES:
+                logger.warning(
+                    f"slow request {scope['method']} {scope['path']}: "
+                    f"{elapsed:.3f}s, {stats.sql_statements} statements, "
+                    f"{stats.sql_seconds:.3f}s in SQL"
+                )
+
+        async def send_observed(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            body = message["type"] == "http.response.body"
+            if body and not message.get("more_body", False):
+                observe()
+
+        try:
+            await self.app(scope, receive, send_observed)
+        finally:
+            request_stats.reset(token)
+            # failed or cut off before the end of the body
+            if not observed:
+                observe()
+
+
+app.add_middleware(CollectMetrics)
+
 
 @app.exception_handler(RequestValidationError)
 def validation_exception_handler(request: Request, exc: RequestValidationError):
@@ -35,58 +272,392 @@ def validation_exception_handler(request: Request, exc: RequestValidationError):
     )
 
 
+@app.exception_handler(ValidationFailed)
+def validation_failed_handler(request: Request, exc: ValidationFailed):
+    logger.info(f"{request.method} {request.url.path}: {exc}")
+    return JSONResponse(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        content=jsonable_encoder(
+            Error(code=status.HTTP_400_BAD_REQUEST, message="Validation Failed")
+        ),
+    )
+
+
 if MODE == Mode.DEBUG:
 
     @app.get("/get_items/")
-    def get_item() -> SystemItemImport:
-        return getUnits()
+    async def get_item(
+        session: AsyncSession = Depends(get_session),
+    ) -> SystemItemImport:
+        return await getUnits(session)
 
     @app.delete("/delete/")
-    def delete_items():
-        return deleteUnits()
+    async def delete_items(session: AsyncSession = Depends(get_session)):
+        return await deleteUnits(session)
 
     @app.get("/get_history/")
-    def get_history():
-        return getHistory()
+    async def get_history(session: AsyncSession = Depends(get_session)):
+        return await getHistory(session)
 
 
 @app.delete("/delete/{id}")
-def delete_item(id: str, date: datetime, response: Response):
-    if not unitExist(id):
+async def delete_item(
+    id: str,
+    date: datetime,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
+    if not await deleteUnit(session, id, date):
         response.status_code = status.HTTP_404_NOT_FOUND
         return Error(code=404, message="Item not found")
-    deleteUnit(id, date)
+    if tree is not None:
+        await tree.sync()
 
 
 @app.post("/imports/")
-def import_items(imported: SystemItemImportRequest, response: Response):
-    return importItems(imported)
+async def import_items(
+    imported: SystemItemImportRequest,
+    response: Response,
+    session: AsyncSession = Depends(get_session),
+):
+    result = await importItems(session, imported)
+    if tree is not None:
+        await tree.sync()
+    return result
+
+
+# Import a NDJSON body of SystemItemImport objects, one per line, of any
+# size. The load is applied atomically, a response reports its throughput.
+@app.post("/imports/bulk")
+async def bulk_import_items(
+    request: Request,
+    updateDate: datetime,
+    session: AsyncSession = Depends(get_session),
+):
+    start = time.perf_counter()
+    count = await bulkImportItems(
+        session, aiter_ndjson_items(request.stream(), BULK_BATCH_SIZE), updateDate
+    )
+    if tree is not None:
+        await tree.sync()
+    elapsed = time.perf_counter() - start
+    return {
+        "items": count,
+        "seconds": elapsed,
+        "itemsPerSecond": count / elapsed if elapsed else 0.0,
+    }
+
+
+# Trees of several units at once, from the cache or from one query for
+# all of them, so overlapping trees are read once. An id of no unit gets
+# an error item instead of failing the request.
+@app.get("/nodes")
+async def get_nodes(
+    response: Response,
+    ids: List[str] = Query(...),
+    session: AsyncSession = Depends(get_session),
+):
+    if len(ids) > NODES_BATCH_SIZE:
+        response.status_code = status.HTTP_400_BAD_REQUEST
+        return Error(code=400, message="Validation Failed")
+    requested = list(dict.fromkeys(ids))
+    memory = loaded_tree()
+    if memory is not None:
+        slots = {id: memory.index.find(id) for id in requested}
+        versions = {
+            id: memory.index.version(slot)
+            for id, slot in slots.items()
+            if slot is not None
+        }
+    else:
+        versions = await getUnitVersions(session, requested)
+
+    bodies: Dict[str, bytes] = {}
+    for id, version in versions.items():
+        body = node_cache.get(id, version)
+        if body is not None:
+            bodies[id] = body
+    missing = [id for id in versions if id not in bodies]
+    if missing and memory is not None:
+        for id in missing:
+            bodies[id] = dump_tree_json(memory.index.subtree(slots[id]), id)
+    elif missing:
+        units, children = group_units(await getSubtrees(session, missing))
+        for id in missing:
+            # deleted after its version was read
+            if id in units:
+                bodies[id] = b"".join(iter_node_json(units[id], children))
+    for id in missing:
+        if id in bodies:
+            node_cache.put(id, versions[id], bodies[id])
+    return Response(
+        content=dump_nodes_json([(id, bodies.get(id)) for id in ids]),
+        media_type="application/json",
+    )
 
 
 @app.get("/nodes/{id}")
-def get_info(id: str, response: Response):
-    if not unitExist(id):
+async def get_info(
+    id: str,
+    response: Response,
+    at: datetime | None = None,
+    depth: int | None = Query(None, ge=0),
+    if_none_match: str | None = Header(None),
+    session: AsyncSession = Depends(get_session),
+):
+    if at is not None:
+        # the tree as it was at the date, rebuilt from history without cache
+        units = await getSubtreeAt(session, id, at)
+        if not units:
+            response.status_code = status.HTTP_404_NOT_FOUND
+            return Error(code=404, message="Item not found")
+        if len(units) > NODE_STREAM_THRESHOLD:
+            return StreamingResponse(
+                iter_tree_json(units, id, depth), media_type="application/json"
+            )
+        return Response(
+            content=dump_tree_json(units, id, depth), media_type="application/json"
+        )
+    memory = loaded_tree()
+    if memory is not None:
+        slot = memory.index.find(id)
+        found = slot is not None
+        if found:
+            version = memory.index.version(slot)
+            etag = make_etag(version, memory.index.date(slot))
+    else:
+        unit = await getUnitVersion(session, id)
+        found = unit is not None
+        if found:
+            version = unit.version
+            etag = make_etag(version, unit.date)
+    if not found:
         response.status_code = status.HTTP_404_NOT_FOUND
         return Error(code=404, message="Item not found")
-    return getUnitInfo(id)
+    # the version changes with anything in the subtree, so a client holding
+    # the current tag gets no tree built or sent
+    headers = {"ETag": etag} if etag is not None else {}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if depth is not None:
+        # A few levels of the tree, folders with their numbers of children.
+        # Sizes are those of whole subtrees, any change below bumps version.
+        body = node_cache.get((id, depth), version)
+        if body is None:
+            if memory is not None:
+                units, counts = memory.index.levels(slot, depth)
+            else:
+                units, counts = await getSubtreeLevels(session, id, depth)
+            if not units:
+                # deleted after its version was read
+                response.status_code = status.HTTP_404_NOT_FOUND
+                return Error(code=404, message="Item not found")
+            body = dump_tree_json(units, id, depth, counts)
+            node_cache.put((id, depth), version, body)
+        return Response(content=body, media_type="application/json", headers=headers)
+    body = node_cache.get(id, version)
+    if body is None:
+        if memory is not None:
+            units = memory.index.subtree(slot)
+        else:
+            units = await getSubtree(session, id)
+        if not units:
+            # deleted after its version was read
+            response.status_code = status.HTTP_404_NOT_FOUND
+            return Error(code=404, message="Item not found")
+        if len(units) > NODE_STREAM_THRESHOLD:
+            return StreamingResponse(
+                iter_tree_json(units, id),
+                media_type="application/json",
+                headers=headers,
+            )
+        body = dump_tree_json(units, id)
+        node_cache.put(id, version, body)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# Changes of units after the log number `since`, a replacement of polling
+# /updates. Without since the feed starts at the latest change. A request
+# without changes to return waits up to `wait` seconds for them and gets
+# an empty page then; `seq` of a page is the `since` of the next one. 410
+# tells a client that fell behind the kept log to reload what it holds.
+@app.get("/changes")
+async def get_changes(
+    response: Response,
+    since: int | None = Query(None, ge=0),
+    limit: int = Query(CHANGES_PAGE_SIZE, ge=1, le=CHANGES_MAX_PAGE_SIZE),
+    wait: float = Query(CHANGES_WAIT_SECONDS, ge=0, le=CHANGES_MAX_WAIT_SECONDS),
+):
+    if "total" not in startup_seconds:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return Error(code=503, message="Service not ready")
+    if since is None:
+        since = feed.seq
+    changes = await feed.wait(since, limit, wait)
+    if changes is None:
+        response.status_code = status.HTTP_410_GONE
+        return Error(code=410, message="Changes are no longer kept")
+    seq = changes[-1][0] if changes else since
+    return Response(
+        content=dump_changes_json(changes, seq), media_type="application/json"
+    )
 
 
+# The same feed as Server-Sent Events, one event per change with its log
+# number as the event id, so a reconnecting client resumes from
+# Last-Event-ID. Comments keep idle connections open.
+@app.get("/changes/stream")
+async def get_changes_stream(
+    response: Response,
+    since: int | None = Query(None, ge=0),
+    last_event_id: int | None = Header(None, ge=0),
+):
+    if "total" not in startup_seconds:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return Error(code=503, message="Service not ready")
+    if last_event_id is not None:
+        since = last_event_id
+    elif since is None:
+        since = feed.seq
+    changes = await feed.read(since, CHANGES_PAGE_SIZE)
+    if changes is None:
+        response.status_code = status.HTTP_410_GONE
+        return Error(code=410, message="Changes are no longer kept")
+
+    async def events(since: int, changes: List) -> AsyncIterator[bytes]:
+        # the stream ends when the client falls behind the kept log, its
+        # reconnect gets 410
+        while changes is not None:
+            if changes:
+                yield dump_change_events(changes)
+                since = changes[-1][0]
+            else:
+                yield b": keep-alive\n\n"
+            changes = await feed.wait(
+                since, CHANGES_PAGE_SIZE, CHANGES_KEEPALIVE_SECONDS
+            )
+
+    return StreamingResponse(
+        events(since, changes),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return node_cache.stats()
+
+
+@app.get("/tree/stats")
+async def get_tree_stats(response: Response):
+    if tree is None:
+        response.status_code = status.HTTP_404_NOT_FOUND
+        return Error(code=404, message="In-memory tree is disabled")
+    return {**tree.index.stats(), "seq": tree.seq}
+
+
+@app.get("/health/live")
+async def get_live():
+    return {"status": "live"}
+
+
+# ready once the worker is warm and the database answers
+@app.get("/health/ready")
+async def get_ready(
+    response: Response, session: AsyncSession = Depends(get_session)
+):
+    if "total" in startup_seconds:
+        try:
+            await ping(session)
+            return {"status": "ready", "startupSeconds": startup_seconds}
+        except (OSError, SQLAlchemyError) as e:
+            logger.warning(f"not ready: {e}")
+    response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return Error(code=503, message="Service not ready")
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=render(), media_type=CONTENT_TYPE_LATEST)
+
+
+# All updates as openapi.yaml specifies them, streamed in bounded memory.
+# Pages with an X-Next-Cursor header only when a limit or cursor is given.
 @app.get("/updates/")
-def get_updates(date: datetime, response: Response):
-    return getUpdates(date)
+async def get_updates(
+    date: datetime,
+    response: Response,
+    limit: int | None = Query(None, ge=1, le=UPDATES_MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    stream: bool = False,
+    session: AsyncSession = Depends(get_session),
+):
+    if stream or (limit is None and cursor is None):
+        return StreamingResponse(
+            aiter_history_json(streamUpdates(session, date, UPDATES_PAGE_SIZE)),
+            media_type="application/json",
+        )
+    after = None
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        if after is None:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return Error(code=400, message="Validation Failed")
+    updates, last = await getUpdates(
+        session, date, limit or UPDATES_PAGE_SIZE, after
+    )
+    if last is not None:
+        response.headers["X-Next-Cursor"] = encode_cursor(*last)
+    return updates
 
 
+# History as openapi.yaml specifies it, all states streamed in bounded
+# memory. Pages with an X-Next-Cursor header only when a limit or cursor is
+# given, or the latest states only.
 @app.get("/node/{id}/history")
-def get_node_history(
+async def get_node_history(
     id: str,
     response: Response,
     dateStart: datetime | None = None,
     dateEnd: datetime | None = None,
+    limit: int | None = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: str | None = None,
+    latest: int | None = Query(None, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    if_none_match: str | None = Header(None),
+    session: AsyncSession = Depends(get_session),
 ):
-    if not unitExist(id):
+    unit = await getUnitVersion(session, id)
+    if unit is None:
         response.status_code = status.HTTP_404_NOT_FOUND
         return Error(code=404, message="Item not found")
     if (dateStart is None) != (dateEnd is None):
         response.status_code = status.HTTP_404_NOT_FOUND
         return Error(code=400, message="Validation Failed")
-    return getNodeHistory(id, dateStart, dateEnd)
+    after = None
+    if cursor is not None:
+        key = decode_cursor(cursor)
+        if key is None or key[1] != id:
+            response.status_code = status.HTTP_400_BAD_REQUEST
+            return Error(code=400, message="Validation Failed")
+        after = key[0]
+    # Every state of the unit bumps its version, and maintenance.py bumps
+    # it when compaction or retention removes states.
+    etag = make_etag(unit.version, unit.date)
+    headers = {"ETag": etag} if etag is not None else {}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if limit is None and cursor is None and latest is None:
+        states = streamNodeHistory(session, id, dateStart, dateEnd, HISTORY_PAGE_SIZE)
+        return StreamingResponse(
+            aiter_history_json(states),
+            media_type="application/json",
+            headers=headers,
+        )
+    response.headers.update(headers)
+    history, last = await getNodeHistory(
+        session, id, dateStart, dateEnd, limit or HISTORY_PAGE_SIZE, after, latest
+    )
+    if last is not None:
+        response.headers["X-Next-Cursor"] = encode_cursor(last, id)
+    return history
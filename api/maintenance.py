@@ -0,0 +1,228 @@
+# Maintenance of the partitioned history table and the change log, run
+# next to the app:
+#
+#   python maintenance.py partitions --ahead 2
+#   python maintenance.py retention --keep-months 24
+#   python maintenance.py compact
+#   python maintenance.py changelog --keep 1000000
+#   python maintenance.py schedule --every 3600
+#
+# partitions creates monthly partitions up to --ahead months from now, so
+# writes rarely have to create one. retention drops the partitions of
+# months older than --keep-months, a DROP TABLE instead of a DELETE.
+# history_legacy, the states from before the partitioning, is dropped
+# once all of its months are. compact removes states equal to the
+# previous state of the same unit, partition by partition, skipping the
+# current month. Units that lose states get
+# new versions, so ETags of their history change. changelog deletes all
+# but the latest --keep changes, /changes clients behind them get 410 and
+# reload. schedule runs partitions and changelog with their defaults every
+# --every seconds until stopped, see the maintenance service of
+# docker-compose.yml.
+import argparse
+import asyncio
+import re
+from datetime import datetime
+from typing import Iterable, List, Tuple
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from config import CHANGES_KEEP, PARTITIONS_AHEAD
+from database import engine
+from db_requests import (
+    WRITE_LOCK,
+    ensureHistoryPartition,
+    historyLegacyEnd,
+    historyPartition,
+)
+
+PARTITION_NAME = re.compile(r"^history_(\d{4})_(\d{2})$")
+
+
+# existing history partitions with their bounds, oldest first
+async def getPartitions() -> List[Tuple[str, datetime, datetime]]:
+    async with engine.connect() as connection:
+        result = await connection.execute(
+            text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'history'::regclass"
+            )
+        )
+        partitions = []
+        for (name,) in result:
+            match = PARTITION_NAME.match(name)
+            if match:
+                year, month = map(int, match.groups())
+                partitions.append(historyPartition(datetime(year, month, 1)))
+        legacyEnd = await historyLegacyEnd(connection)
+        if legacyEnd is not None:
+            partitions.append(("history_legacy", datetime.min, legacyEnd))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def addMonths(date: datetime, months: int) -> datetime:
+    month = date.year * 12 + date.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+async def createPartitions(ahead: int) -> None:
+    now = datetime.utcnow()
+    for months in range(ahead + 1):
+        date = addMonths(now, months)
+        await ensureHistoryPartition(date)
+        logger.info(f"partition {historyPartition(date)[0]} is ready")
+
+
+# Give units whose history changed new versions, see Unit.version. The
+# write lock keeps writers out until the commit, so a unit is never
+# written between the change of its history and the new version.
+async def bumpVersions(connection: AsyncConnection, ids: Iterable[str]) -> None:
+    await connection.execute(
+        text("SELECT pg_advisory_xact_lock(:key)"), {"key": WRITE_LOCK}
+    )
+    await connection.execute(
+        text(
+            "UPDATE unit SET version = nextval('unit_version_seq') "
+            "WHERE id = ANY(:ids)"
+        ),
+        {"ids": list(ids)},
+    )
+
+
+async def dropPartitions(keep_months: int, dry_run: bool) -> None:
+    oldest = addMonths(datetime.utcnow(), -keep_months)
+    for name, start, end in await getPartitions():
+        if end > oldest:
+            break
+        logger.info(f"dropping partition {name}")
+        if not dry_run:
+            async with engine.begin() as connection:
+                result = await connection.execute(
+                    text(f"SELECT DISTINCT unit_id FROM {name}")
+                )
+                ids = result.scalars().all()
+                await bumpVersions(connection, ids)
+                await connection.execute(text(f"DROP TABLE {name}"))
+
+
+# A state equal to the previous state of the unit is deleted. The first
+# state of a unit in the month is compared to its last state before it.
+# Columns are compared one by one, rows with nulls never compare equal.
+COMPACT = """
+WITH removed AS (
+    DELETE FROM {name} h USING (
+        SELECT s.unit_id, s.date FROM (
+            SELECT date, unit_id, url, "parentId", type, size,
+                row_number() OVER w AS number,
+                lag(url) OVER w AS previous_url,
+                lag("parentId") OVER w AS "previous_parentId",
+                lag(type) OVER w AS previous_type,
+                lag(size) OVER w AS previous_size
+            FROM {name}
+            WINDOW w AS (PARTITION BY unit_id ORDER BY date)
+        ) s
+        LEFT JOIN LATERAL (
+            SELECT p.url, p."parentId", p.type, p.size
+            FROM history p
+            WHERE s.number = 1 AND p.unit_id = s.unit_id AND p.date < :start
+            ORDER BY p.date DESC
+            LIMIT 1
+        ) p ON true
+        WHERE CASE WHEN s.number > 1 THEN
+            s.url IS NOT DISTINCT FROM s.previous_url
+            AND s."parentId" IS NOT DISTINCT FROM s."previous_parentId"
+            AND s.type = s.previous_type
+            AND s.size IS NOT DISTINCT FROM s.previous_size
+        ELSE
+            s.type = p.type
+            AND s.url IS NOT DISTINCT FROM p.url
+            AND s."parentId" IS NOT DISTINCT FROM p."parentId"
+            AND s.size IS NOT DISTINCT FROM p.size
+        END
+    ) d
+    WHERE h.unit_id = d.unit_id AND h.date = d.date
+    RETURNING h.unit_id
+)
+SELECT unit_id, count(*) FROM removed GROUP BY unit_id
+"""
+
+
+async def compactPartitions() -> None:
+    current = addMonths(datetime.utcnow(), 0)
+    for name, start, end in await getPartitions():
+        if end > current:
+            break
+        async with engine.begin() as connection:
+            result = await connection.execute(
+                text(COMPACT.format(name=name)), {"start": start}
+            )
+            removed = dict(result.all())
+            await bumpVersions(connection, removed)
+        logger.info(
+            f"compacted {name}: {sum(removed.values())} states "
+            f"of {len(removed)} units removed"
+        )
+
+
+async def trimChangeLog(keep: int) -> None:
+    async with engine.begin() as connection:
+        result = await connection.execute(
+            text(
+                "DELETE FROM change_log "
+                "WHERE seq <= (SELECT max(seq) FROM change_log) - :keep"
+            ),
+            {"keep": keep},
+        )
+    logger.info(f"change log: {result.rowcount} changes removed")
+
+
+async def schedule(every: float) -> None:
+    while True:
+        try:
+            await createPartitions(PARTITIONS_AHEAD)
+            await trimChangeLog(CHANGES_KEEP)
+        except (OSError, SQLAlchemyError) as e:
+            logger.warning(f"maintenance failed, next run in {every:.0f}s: {e}")
+        await asyncio.sleep(every)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="history table maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    partitions = commands.add_parser("partitions", help="create future partitions")
+    partitions.add_argument(
+        "--ahead", type=int, default=PARTITIONS_AHEAD, help="months ahead"
+    )
+    retention = commands.add_parser("retention", help="drop old partitions")
+    retention.add_argument("--keep-months", type=int, required=True)
+    retention.add_argument("--dry-run", action="store_true")
+    commands.add_parser("compact", help="collapse repeated states")
+    changelog = commands.add_parser("changelog", help="trim the change log")
+    changelog.add_argument(
+        "--keep", type=int, default=CHANGES_KEEP, help="latest changes"
+    )
+    scheduled = commands.add_parser("schedule", help="run partitions and changelog")
+    scheduled.add_argument("--every", type=float, default=3600, help="seconds")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> None:
+    if args.command == "partitions":
+        await createPartitions(args.ahead)
+    elif args.command == "retention":
+        await dropPartitions(args.keep_months, args.dry_run)
+    elif args.command == "changelog":
+        await trimChangeLog(args.keep)
+    elif args.command == "schedule":
+        await schedule(args.every)
+    else:
+        await compactPartitions()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
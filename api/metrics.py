@@ -0,0 +1,157 @@
+# Prometheus metrics of requests, SQL statements, the pool and the cache.
+# Under gunicorn every worker writes its samples to PROMETHEUS_MULTIPROC_DIR
+# and /metrics merges the files of all workers, see gunicorn.conf.py.
+import os
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from cache import ResponseCache
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to handle a request",
+    ["method", "route", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "http_request_sql_statements",
+    "SQL statements executed while handling a request",
+    ["method", "route"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+REQUEST_SQL_DURATION = Histogram(
+    "http_request_sql_duration_seconds",
+    "Total time of SQL statements executed while handling a request",
+    ["method", "route"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Connections taken from the pool"
+)
+POOL_WAIT = Histogram(
+    "db_pool_wait_seconds",
+    "Time spent waiting for a pooled connection",
+    buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5),
+)
+POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Connections currently in use",
+    multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "node_cache_lookups_total", "Lookups in the /nodes response cache", ["result"]
+)
+CACHE_EVICTIONS = Counter(
+    "node_cache_evictions_total", "Entries evicted from the /nodes response cache"
+)
+STARTUP_SECONDS = Gauge(
+    "app_startup_seconds",
+    "Time of every startup step of the slowest worker",
+    ["step"],
+    multiprocess_mode="max",
+)
+
+
+# Statements executed on behalf of the current request. The middleware puts
+# a fresh object into the context var, SQLAlchemy events add to it.
+@dataclass
+class RequestStats:
+    sql_statements: int = 0
+    sql_seconds: float = 0.0
+
+
+request_stats: ContextVar[RequestStats | None] = ContextVar(
+    "request_stats", default=None
+)
+
+
+class InstrumentedPool(AsyncAdaptedQueuePool):
+    """Queue pool that measures how long checkouts wait for a connection."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - start)
+
+
+class InstrumentedCache(ResponseCache):
+    """Response cache that also reports hits, misses and evictions."""
+
+    def get(self, key, version):
+        body = super().get(key, version)
+        CACHE_LOOKUPS.labels("miss" if body is None else "hit").inc()
+        return body
+
+    def put(self, key, version, body):
+        evictions = self.evictions
+        super().put(key, version, body)
+        if self.evictions > evictions:
+            CACHE_EVICTIONS.inc(self.evictions - evictions)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.sql_statements += 1
+        stats.sql_seconds += time.perf_counter() - context._metrics_start
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    POOL_CHECKOUTS.inc()
+    POOL_CHECKED_OUT.inc()
+
+
+def _checkin(dbapi_connection, connection_record):
+    POOL_CHECKED_OUT.dec()
+
+
+def instrument_engine(engine) -> None:
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine.pool, "checkout", _checkout)
+    event.listen(engine.pool, "checkin", _checkin)
+
+
+def observe_request(
+    method: str, route: str, status: int, seconds: float, stats: RequestStats
+) -> None:
+    REQUEST_LATENCY.labels(method, route, status).observe(seconds)
+    REQUEST_SQL_STATEMENTS.labels(method, route).observe(stats.sql_statements)
+    REQUEST_SQL_DURATION.labels(method, route).observe(stats.sql_seconds)
+
+
+def observe_startup(steps: Dict[str, float]) -> None:
+    for step, seconds in steps.items():
+        STARTUP_SECONDS.labels(step).set(seconds)
+
+
+# Exposition of all metrics, merged over workers in multiprocess mode
+def render() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
+
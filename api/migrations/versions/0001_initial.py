@@ -0,0 +1,114 @@
+"""initial schema
+
+Databases created before migrations were introduced already have some of
+these tables, so only the missing ones are created.
+
+Revision ID: 0001
+Revises:
+Create Date: 2022-10-01 12:00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+system_item_type = postgresql.ENUM(
+    "FILE", "FOLDER", name="systemitemtype", create_type=False
+)
+
+
+def upgrade() -> None:
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    tables = inspector.get_table_names()
+    system_item_type.create(bind, checkfirst=True)
+
+    if "unit" not in tables:
+        op.create_table(
+            "unit",
+            sa.Column("id", sa.String(length=256), nullable=False),
+            sa.Column("url", sa.String(length=256), nullable=True),
+            sa.Column("date", sa.DateTime(), nullable=True),
+            sa.Column("parentId", sa.String(length=256), nullable=True),
+            sa.Column("type", system_item_type, nullable=True),
+            sa.Column("size", sa.BigInteger(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+
+    if "history" not in tables:
+        op.create_table(
+            "history",
+            sa.Column("id", sa.Integer(), autoincrement=True, nullable=False),
+            sa.Column("unit_id", sa.String(length=256), nullable=True),
+            sa.Column("url", sa.String(length=256), nullable=True),
+            sa.Column("date", sa.DateTime(), nullable=True),
+            sa.Column("parentId", sa.String(length=256), nullable=True),
+            sa.Column("type", system_item_type, nullable=True),
+            sa.Column("size", sa.BigInteger(), nullable=True),
+            sa.PrimaryKeyConstraint("id"),
+        )
+    valid = bind.execute(
+        sa.text(
+            "SELECT indisvalid FROM pg_index "
+            "WHERE indexrelid = to_regclass('ix_history_unit_id_date')"
+        )
+    ).scalar()
+    if not valid:
+        # Built concurrently, history stays writable. A state written twice
+        # with the same date meanwhile fails the build and leaves an invalid
+        # index, which is dropped when the migration is run again.
+        with op.get_context().autocommit_block():
+            op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_history_unit_id_date")
+            # keep the latest row of every state written with the same date
+            op.execute(
+                """
+                DELETE FROM history h
+                USING history newer
+                WHERE newer.unit_id = h.unit_id
+                  AND newer.date = h.date
+                  AND newer.id > h.id
+                """
+            )
+            op.execute(
+                "CREATE UNIQUE INDEX CONCURRENTLY ix_history_unit_id_date "
+                "ON history (unit_id, date)"
+            )
+
+    if "unit_tree" not in tables:
+        op.create_table(
+            "unit_tree",
+            sa.Column("ancestor_id", sa.String(length=256), nullable=False),
+            sa.Column("descendant_id", sa.String(length=256), nullable=False),
+            sa.Column("depth", sa.Integer(), nullable=False),
+            sa.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+        )
+        op.create_index(
+            "ix_unit_tree_descendant_id", "unit_tree", ["descendant_id"], unique=False
+        )
+        op.execute(
+            """
+            WITH RECURSIVE chain (descendant_id, ancestor_id, parent_id, depth) AS (
+                SELECT id, id, "parentId", 0 FROM unit
+                UNION ALL
+                SELECT chain.descendant_id, unit.id, unit."parentId", chain.depth + 1
+                FROM chain JOIN unit ON unit.id = chain.parent_id
+            )
+            INSERT INTO unit_tree (ancestor_id, descendant_id, depth)
+            SELECT ancestor_id, descendant_id, depth FROM chain
+            """
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_unit_tree_descendant_id", table_name="unit_tree")
+    op.drop_table("unit_tree")
+    op.drop_index("ix_history_unit_id_date", table_name="history")
+    op.drop_table("history")
+    op.drop_table("unit")
+    system_item_type.drop(op.get_bind(), checkfirst=True)
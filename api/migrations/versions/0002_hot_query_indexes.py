@@ -0,0 +1,35 @@
+"""indexes for hot queries
+
+Indexes are built concurrently, so the tables stay writable while an
+existing database is upgraded.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2022-10-02 12:00:00
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_unit_parentId" '
+            'ON unit ("parentId")'
+        )
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_unit_type_date "
+            "ON unit (type, date)"
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS "ix_unit_parentId"')
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_unit_type_date")
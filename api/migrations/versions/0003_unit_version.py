@@ -0,0 +1,31 @@
+"""unit version for response caching
+
+The column is added without a table rewrite: existing units keep a null
+version until their subtree is written to.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2022-10-03 12:00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE SEQUENCE unit_version_seq")
+    op.add_column("unit", sa.Column("version", sa.BigInteger(), nullable=True))
+    op.alter_column(
+        "unit", "version", server_default=sa.text("nextval('unit_version_seq')")
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("unit", "version")
+    op.execute("DROP SEQUENCE unit_version_seq")
@@ -0,0 +1,35 @@
+"""index for keyset pagination of /updates
+
+Replaces the (type, date) index with (type, date, id), which also serves
+the (date, id) ordering of update pages.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2022-10-04 12:00:00
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_unit_type_date_id "
+            "ON unit (type, date, id)"
+        )
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_unit_type_date")
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_unit_type_date "
+            "ON unit (type, date)"
+        )
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_unit_type_date_id")
@@ -0,0 +1,32 @@
+"""change log of units
+
+Every committed write appends the ids of changed and deleted units, the
+in-memory trees of workers follow the log.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2022-10-06 12:00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "change_log",
+        sa.Column("seq", sa.BigInteger(), autoincrement=True, nullable=False),
+        sa.Column("unit_id", sa.String(length=256), nullable=False),
+        sa.Column("deleted", sa.Boolean(), nullable=False),
+        sa.PrimaryKeyConstraint("seq"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("change_log")
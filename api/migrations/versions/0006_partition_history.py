@@ -0,0 +1,126 @@
+"""partition history by month
+
+history becomes a table partitioned by RANGE (date). The existing table
+is not copied: it is attached as the partition history_legacy holding
+all dates up to the end of the month of the latest state, an empty table
+is dropped instead. Further monthly partitions history_YYYY_MM are
+created on demand by the app and ahead of time by maintenance.py.
+
+The primary key has to include the partition key, so the unique index
+on (unit_id, date) becomes the primary key and the surrogate id column
+is dropped. States without a unit or a date cannot be placed into a
+partition and are deleted.
+
+Only metadata changes are made under an exclusive lock. The check
+constraint proving the partition bound is validated first, outside of
+the migration transaction, while history stays readable and writable,
+so neither SET NOT NULL nor ATTACH PARTITION scan the table. States
+written with dates after the bound while the migration runs are
+rejected by the check.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2022-10-07 12:00:00
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+CREATE = """
+CREATE TABLE history (
+    unit_id varchar(256) NOT NULL,
+    url varchar(256),
+    date timestamp without time zone NOT NULL,
+    "parentId" varchar(256),
+    type systemitemtype,
+    size bigint,
+    CONSTRAINT history_pkey PRIMARY KEY (unit_id, date)
+) PARTITION BY RANGE (date)
+"""
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DELETE FROM history WHERE unit_id IS NULL OR date IS NULL")
+        cutoff = (
+            op.get_bind()
+            .execute(
+                sa.text(
+                    "SELECT date_trunc('month', max(date)) + interval '1 month' "
+                    "FROM history"
+                )
+            )
+            .scalar()
+        )
+        if cutoff is None:
+            op.execute("DROP TABLE history")
+            op.execute(CREATE)
+            return
+        op.execute(
+            "ALTER TABLE history ADD CONSTRAINT history_legacy_bound CHECK ("
+            "unit_id IS NOT NULL AND date IS NOT NULL "
+            f"AND date < '{cutoff:%Y-%m-%d}'::timestamp) NOT VALID"
+        )
+        op.execute("ALTER TABLE history VALIDATE CONSTRAINT history_legacy_bound")
+
+    op.execute("ALTER TABLE history RENAME TO history_legacy")
+    op.execute("ALTER TABLE history_legacy ALTER COLUMN unit_id SET NOT NULL")
+    op.execute("ALTER TABLE history_legacy ALTER COLUMN date SET NOT NULL")
+    op.execute("ALTER TABLE history_legacy DROP CONSTRAINT history_pkey")
+    # drops history_id_seq owned by the column as well
+    op.execute("ALTER TABLE history_legacy DROP COLUMN id")
+    op.execute("ALTER INDEX ix_history_unit_id_date RENAME TO history_legacy_pkey")
+    op.execute(
+        "ALTER TABLE history_legacy ADD CONSTRAINT history_legacy_pkey "
+        "PRIMARY KEY USING INDEX history_legacy_pkey"
+    )
+    op.execute(CREATE)
+    op.execute(
+        "ALTER TABLE history ATTACH PARTITION history_legacy "
+        f"FOR VALUES FROM (MINVALUE) TO ('{cutoff:%Y-%m-%d}')"
+    )
+
+
+def downgrade() -> None:
+    legacy = op.get_bind().execute(sa.text("SELECT to_regclass('history_legacy')"))
+    legacy = legacy.scalar() is not None
+    op.execute("ALTER TABLE history RENAME TO history_partitioned")
+    op.execute(
+        "ALTER TABLE history_partitioned "
+        "RENAME CONSTRAINT history_pkey TO history_partitioned_pkey"
+    )
+    if legacy:
+        op.execute("ALTER TABLE history_partitioned DETACH PARTITION history_legacy")
+        op.execute("ALTER TABLE history_legacy RENAME TO history")
+        op.execute("ALTER TABLE history DROP CONSTRAINT history_legacy_bound")
+        op.execute("ALTER TABLE history DROP CONSTRAINT history_legacy_pkey")
+    else:
+        op.execute(
+            """
+            CREATE TABLE history (
+                unit_id varchar(256),
+                url varchar(256),
+                date timestamp without time zone,
+                "parentId" varchar(256),
+                type systemitemtype,
+                size bigint
+            )
+            """
+        )
+    op.execute(
+        'INSERT INTO history (unit_id, url, date, "parentId", type, size) '
+        'SELECT unit_id, url, date, "parentId", type, size FROM history_partitioned'
+    )
+    op.execute("DROP TABLE history_partitioned")
+    op.create_index(
+        "ix_history_unit_id_date", "history", ["unit_id", "date"], unique=True
+    )
+    op.execute("ALTER TABLE history ADD COLUMN id serial PRIMARY KEY")
+    op.execute("ALTER TABLE history ALTER COLUMN unit_id DROP NOT NULL")
+    op.execute("ALTER TABLE history ALTER COLUMN date DROP NOT NULL")
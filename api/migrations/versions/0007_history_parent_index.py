@@ -0,0 +1,49 @@
+"""index of history by parent for point-in-time trees
+
+The index is created on the partitioned table only, then built
+concurrently on every partition and attached, so history stays writable
+while an existing database is upgraded. Partitions created later get the
+index automatically.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2022-10-12 12:00:00
+
+"""
+from alembic import op
+from sqlalchemy import text
+
+# revision identifiers, used by Alembic.
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute(
+        'CREATE INDEX IF NOT EXISTS "ix_history_parentId_date" '
+        'ON ONLY history ("parentId", date)'
+    )
+    partitions = op.get_bind().execute(
+        text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = 'history'::regclass"
+        )
+    )
+    names = partitions.scalars().all()
+    with op.get_context().autocommit_block():
+        for name in names:
+            op.execute(
+                f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_{name}_parentId_date" '
+                f'ON {name} ("parentId", date)'
+            )
+            op.execute(
+                'ALTER INDEX "ix_history_parentId_date" '
+                f'ATTACH PARTITION "ix_{name}_parentId_date"'
+            )
+
+
+def downgrade() -> None:
+    op.execute('DROP INDEX IF EXISTS "ix_history_parentId_date"')
@@ -0,0 +1,31 @@
+"""index of closure rows by ancestor and depth
+
+Serves /nodes/{id}?depth=, which reads only the first levels of a subtree.
+The descendant id is in the index, so the levels are read from the index
+alone. Built concurrently, the table stays writable during an upgrade.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2022-10-14 12:00:00
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_unit_tree_ancestor_id_depth "
+            "ON unit_tree (ancestor_id, depth, descendant_id)"
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.execute("DROP INDEX CONCURRENTLY IF EXISTS ix_unit_tree_ancestor_id_depth")
@@ -0,0 +1,230 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Tuple
+
+import orjson
+from pydantic import ValidationError
+
+from models import SystemItemImport, SystemItemType
+from utils import time_to_str
+from validation import ValidationFailed, check_item
+
+TYPES = {item_type: orjson.dumps(item_type.value) for item_type in SystemItemType}
+
+CHUNK_SIZE = 64 * 1024
+
+NOT_FOUND = orjson.dumps({"code": 404, "message": "Item not found"})
+
+
+# Encode rows of a subtree as a SystemItem JSON document, yielding chunks of
+# about CHUNK_SIZE bytes. Rows need id, url, date, parentId, type and size.
+# The tree is walked with an explicit stack, so deep trees do not hit the
+# recursion limit, and no intermediate objects are built per node.
+def iter_tree_json(
+    units: Iterable,
+    root_id: str,
+    depth: int | None = None,
+    counts: Dict[str, int] | None = None,
+) -> Iterator[bytes]:
+    children: Dict[str, List] = defaultdict(list)
+    root = None
+    for unit in units:
+        if unit.id == root_id:
+            root = unit
+        else:
+            children[unit.parentId].append(unit)
+    yield from iter_node_json(root, children, depth, counts)
+
+
+# Encode the unit with its descendants, found in the lists of children by
+# parent id. The lists are only read, so subtrees may share them. With a
+# depth, folders get a childrenCount and those `depth` levels below the
+# root get null children, their counts are taken from `counts` or, without
+# it, from the lists of children.
+def iter_node_json(
+    root,
+    children: Dict[str, List],
+    depth: int | None = None,
+    counts: Dict[str, int] | None = None,
+) -> Iterator[bytes]:
+    # most units of a tree share a handful of import dates
+    dates: Dict[datetime, bytes] = {}
+
+    def head(unit) -> bytes:
+        date = dates.get(unit.date)
+        if date is None:
+            date = dates[unit.date] = orjson.dumps(time_to_str(unit.date))
+        return b'{"id":%b,"url":%b,"date":%b,"parentId":%b,"type":%b,"size":%b,"children":' % (
+            orjson.dumps(unit.id),
+            orjson.dumps(unit.url),
+            date,
+            orjson.dumps(unit.parentId),
+            TYPES[unit.type],
+            orjson.dumps(unit.size),
+        )
+
+    buffer = bytearray()
+    # iterators over children lists of the folders being written, with the
+    # bytes that close every folder
+    stack = [iter((root,))]
+    ends = []
+    comma = False
+    while stack:
+        unit = next(stack[-1], None)
+        if unit is None:
+            stack.pop()
+            if stack:
+                buffer += ends.pop()
+            comma = True
+            continue
+        if comma:
+            buffer += b","
+        buffer += head(unit)
+        if unit.type != SystemItemType.FOLDER:
+            buffer += b"null}"
+            comma = True
+        elif depth is not None and len(stack) > depth:
+            if counts is None:
+                count = len(children.get(unit.id, ()))
+            else:
+                count = counts.get(unit.id, 0)
+            buffer += b'null,"childrenCount":%d}' % count
+            comma = True
+        else:
+            folder = children.get(unit.id, ())
+            buffer += b"["
+            stack.append(iter(folder))
+            if depth is None:
+                ends.append(b"]}")
+            else:
+                ends.append(b'],"childrenCount":%d}' % len(folder))
+            comma = False
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    yield bytes(buffer)
+
+
+def dump_tree_json(
+    units: Iterable,
+    root_id: str,
+    depth: int | None = None,
+    counts: Dict[str, int] | None = None,
+) -> bytes:
+    return b"".join(iter_tree_json(units, root_id, depth, counts))
+
+
+# rows by id and lists of children by parent id, see iter_node_json
+def group_units(units: Iterable) -> Tuple[Dict[str, object], Dict[str, List]]:
+    by_id = {}
+    children: Dict[str, List] = defaultdict(list)
+    for unit in units:
+        by_id[unit.id] = unit
+        children[unit.parentId].append(unit)
+    return by_id, children
+
+
+# Encode the response of a batch of /nodes requests: every requested id
+# with its encoded tree, or with an error if there is no such unit.
+def dump_nodes_json(nodes: List[Tuple[str, bytes | None]]) -> bytes:
+    items = []
+    for id, body in nodes:
+        if body is None:
+            item = b'"node":null,"error":%b' % NOT_FOUND
+        else:
+            item = b'"node":%b,"error":null' % body
+        items.append(b'{"id":%b,%b}' % (orjson.dumps(id), item))
+    return b'{"items":[%b]}' % b",".join(items)
+
+
+# Encode batches of rows as a SystemItemHistoryResponse JSON document.
+# Rows need id, url, parentId, type, size and date.
+async def aiter_history_json(batches: AsyncIterator[List]) -> AsyncIterator[bytes]:
+    yield b'{"items":['
+    comma = b""
+    async for rows in batches:
+        buffer = bytearray()
+        for row in rows:
+            buffer += comma
+            buffer += b'{"id":%b,"url":%b,"parentId":%b,"type":%b,"size":%b,"date":%b}' % (
+                orjson.dumps(row.id),
+                orjson.dumps(row.url),
+                orjson.dumps(row.parentId),
+                TYPES[row.type],
+                orjson.dumps(row.size),
+                orjson.dumps(row.date),
+            )
+            comma = b","
+        yield bytes(buffer)
+    yield b"]}"
+
+
+# Encode a change of the change log as {"seq", "id", "deleted", "item"},
+# item is the current state of the unit without children, null once the
+# unit is deleted. Rows are those of getChanges.
+def dump_change_json(row) -> bytes:
+    if row.id is None:
+        item = b"null"
+    else:
+        item = b'{"id":%b,"url":%b,"date":%b,"parentId":%b,"type":%b,"size":%b}' % (
+            orjson.dumps(row.id),
+            orjson.dumps(row.url),
+            orjson.dumps(time_to_str(row.date)),
+            orjson.dumps(row.parentId),
+            TYPES[row.type],
+            orjson.dumps(row.size),
+        )
+    return b'{"seq":%d,"id":%b,"deleted":%b,"item":%b}' % (
+        row.seq,
+        orjson.dumps(row.unit_id),
+        b"true" if row.deleted else b"false",
+        item,
+    )
+
+
+# a page of the change feed, `seq` is the cursor of the next page
+def dump_changes_json(changes: Iterable[Tuple[int, bytes]], seq: int) -> bytes:
+    return b'{"items":[%b],"seq":%d}' % (
+        b",".join(change for _, change in changes),
+        seq,
+    )
+
+
+# changes as Server-Sent Events with log numbers as event ids
+def dump_change_events(changes: Iterable[Tuple[int, bytes]]) -> bytes:
+    return b"".join(b"id: %d\ndata: %b\n\n" % change for change in changes)
+
+
+# Decode a NDJSON stream of SystemItemImport objects, one per line, into
+# batches of checked items. Only the current batch and one incomplete line
+# are held in memory.
+async def aiter_ndjson_items(
+    chunks: AsyncIterator[bytes], batch_size: int
+) -> AsyncIterator[List[SystemItemImport]]:
+    batch: List[SystemItemImport] = []
+    rest = b""
+    number = 0
+    async for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            number += 1
+            if line.strip():
+                batch.append(decode_item(line, number))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    number += 1
+    if rest.strip():
+        batch.append(decode_item(rest, number))
+    if batch:
+        yield batch
+
+
+def decode_item(line: bytes, number: int) -> SystemItemImport:
+    try:
+        item = SystemItemImport.parse_obj(orjson.loads(line))
+    except (orjson.JSONDecodeError, ValidationError):
+        raise ValidationFailed(f"line {number} is not a SystemItemImport")
+    check_item(item)
+    return item
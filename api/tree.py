@@ -0,0 +1,319 @@
+import asyncio
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sys import getsizeof
+from typing import Dict, Iterable, List, Set, Tuple
+
+from loguru import logger
+
+from changes import listen
+from config import TREE_POLL_SECONDS, TREE_SYNC_BATCH
+from database import Session
+from db_requests import getChanges, lastChange, streamTree
+from models import SystemItemType
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# the same fields as the rows of getSubtree, accepted by iter_tree_json
+TreeUnit = namedtuple("TreeUnit", ["id", "url", "date", "parentId", "type", "size"])
+
+
+def warn_missing(missing: Iterable[Tuple[str, str]]) -> None:
+    for id, parentId in missing:
+        logger.warning(f"tree: parent {parentId} of {id} is missing")
+
+
+class TreeIndex:
+    """Hierarchy of units in parallel arrays indexed by slot numbers.
+
+    Ids map to slots once, scalars live in typed arrays of 8 bytes per unit,
+    children of a folder are an array of slots, freed slots are reused.
+    Bookkeeping is about 110 bytes per unit, the id and url strings add
+    about 50 bytes plus their length each: bench/tree_memory.py measures
+    about 260 bytes per unit for benchmark trees.
+    """
+
+    def __init__(self):
+        self.slots: Dict[str, int] = {}
+        self.ids: List[str | None] = []
+        self.urls: List[str | None] = []
+        self.parents = array("q")
+        self.sizes = array("q")
+        self.dates = array("q")
+        # -1 for units written before versions were introduced
+        self.versions = array("q")
+        self.folders = bytearray()
+        self.children: List[array | None] = []
+        self.free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def find(self, id: str) -> int | None:
+        return self.slots.get(id)
+
+    def version(self, slot: int) -> int | None:
+        version = self.versions[slot]
+        return None if version < 0 else version
+
+    def date(self, slot: int) -> datetime:
+        return EPOCH + self.dates[slot] * MICROSECOND
+
+    def _allocate(self, id: str) -> int:
+        if self.free:
+            slot = self.free.pop()
+            self.ids[slot] = id
+        else:
+            slot = len(self.ids)
+            self.ids.append(id)
+            self.urls.append(None)
+            self.parents.append(-1)
+            self.sizes.append(0)
+            self.dates.append(0)
+            self.versions.append(-1)
+            self.folders.append(0)
+            self.children.append(None)
+        self.slots[id] = slot
+        return slot
+
+    # Write current states of units, rows are like those of streamTree.
+    # Returns the parents to link once every unit of the batch has a slot.
+    def write(self, rows: Iterable) -> List[Tuple[int, str | None]]:
+        links = []
+        for row in rows:
+            slot = self.slots.get(row.id)
+            if slot is None:
+                slot = self._allocate(row.id)
+            self.urls[slot] = row.url
+            self.sizes[slot] = row.size or 0
+            self.dates[slot] = (row.date - EPOCH) // MICROSECOND
+            self.versions[slot] = -1 if row.version is None else row.version
+            folder = row.type == SystemItemType.FOLDER
+            self.folders[slot] = folder
+            if folder and self.children[slot] is None:
+                self.children[slot] = array("q")
+            links.append((slot, row.parentId))
+        return links
+
+    # Link units to their parents. Returns ids and parents of the units whose
+    # parents have no slots yet, those are left without a parent meanwhile.
+    def link(self, links: Iterable[Tuple[int, str | None]]) -> List[Tuple[str, str]]:
+        missing = []
+        for slot, parentId in links:
+            parent = -1
+            if parentId is not None:
+                parent = self.slots.get(parentId, -1)
+                if parent < 0:
+                    missing.append((self.ids[slot], parentId))
+            old = self.parents[slot]
+            if old == parent:
+                continue
+            if old >= 0:
+                self.children[old].remove(slot)
+            if parent >= 0:
+                self.children[parent].append(slot)
+            self.parents[slot] = parent
+        return missing
+
+    # remove the unit with all its descendants
+    def delete(self, id: str) -> None:
+        root = self.slots.get(id)
+        if root is None:
+            return
+        if self.parents[root] >= 0:
+            self.children[self.parents[root]].remove(root)
+        stack = [root]
+        while stack:
+            slot = stack.pop()
+            if self.children[slot] is not None:
+                stack.extend(self.children[slot])
+            del self.slots[self.ids[slot]]
+            self.ids[slot] = None
+            self.urls[slot] = None
+            self.children[slot] = None
+            self.parents[slot] = -1
+            self.free.append(slot)
+
+    # the unit in the slot and all its descendants, parents before children,
+    # or only those at most `depth` levels below it
+    def subtree(self, root: int, depth: int | None = None) -> List[TreeUnit]:
+        dates: Dict[int, datetime] = {}
+        units = []
+        stack = [(root, 0)]
+        while stack:
+            slot, level = stack.pop()
+            date = self.dates[slot]
+            if date not in dates:
+                dates[date] = EPOCH + date * MICROSECOND
+            parent = self.parents[slot]
+            folder = self.folders[slot]
+            units.append(
+                TreeUnit(
+                    self.ids[slot],
+                    self.urls[slot],
+                    dates[date],
+                    None if parent < 0 else self.ids[parent],
+                    SystemItemType.FOLDER if folder else SystemItemType.FILE,
+                    self.sizes[slot],
+                )
+            )
+            if folder and (depth is None or level < depth):
+                children = reversed(self.children[slot])
+                stack.extend((child, level + 1) for child in children)
+        return units
+
+    # the subtree `depth` levels deep with the numbers of children of its
+    # folders, the same as getSubtreeLevels
+    def levels(
+        self, root: int, depth: int
+    ) -> Tuple[List[TreeUnit], Dict[str, int]]:
+        units = self.subtree(root, depth)
+        counts = {
+            unit.id: len(self.children[self.slots[unit.id]])
+            for unit in units
+            if unit.type == SystemItemType.FOLDER
+        }
+        return units, counts
+
+    # bytes held by the index, strings of ids and urls included
+    def memory(self) -> int:
+        total = getsizeof(self.slots) + getsizeof(self.free)
+        for values in (self.parents, self.sizes, self.dates, self.versions, self.folders):
+            total += getsizeof(values)
+        for strings in (self.ids, self.urls):
+            total += getsizeof(strings)
+            total += sum(getsizeof(string) for string in strings if string is not None)
+        total += getsizeof(self.children)
+        total += sum(getsizeof(slots) for slots in self.children if slots is not None)
+        return total
+
+    def stats(self) -> Dict[str, int | float]:
+        memory = self.memory()
+        return {
+            "units": len(self),
+            "bytes": memory,
+            "bytesPerUnit": memory / len(self) if self.slots else 0.0,
+        }
+
+
+class TreeEngine:
+    """Copy of the units hierarchy kept in sync with the change log.
+
+    The tree is loaded from a consistent snapshot at startup, then changes
+    are applied in log order: on a notification of another worker, after
+    a write of this worker, and every TREE_POLL_SECONDS in case a
+    notification is lost. Postgres stays the source of truth, other
+    workers' writes become visible after a notification round trip.
+    """
+
+    def __init__(self):
+        self.index = TreeIndex()
+        self.seq = 0
+        self.lock = asyncio.Lock()
+        self.dirty = False
+        self.syncing: asyncio.Task | None = None
+        self.listening: asyncio.Task | None = None
+        self.loaded = False
+
+    # The tree is loaded from a snapshot taken after the last change was
+    # read, so changes after it may be both loaded and replayed by sync.
+    # Replaying writes current states again and is harmless. A failed load
+    # leaves the engine empty and can be started again, a loaded one is
+    # not loaded twice.
+    async def start(self) -> None:
+        if self.loaded:
+            return
+        index = TreeIndex()
+        async with Session() as session:
+            seq = await lastChange(session)
+        async with Session() as session:
+            await session.connection(
+                execution_options={"isolation_level": "REPEATABLE READ"}
+            )
+            links = []
+            async for rows in streamTree(session, TREE_SYNC_BATCH):
+                links += index.write(rows)
+            warn_missing(index.link(links))
+        self.index, self.seq, self.loaded = index, seq, True
+        logger.info(f"tree: loaded {len(self.index)} units at change {self.seq}")
+        self.listening = asyncio.create_task(
+            listen(self._notified, "tree", TREE_POLL_SECONDS)
+        )
+
+    async def stop(self) -> None:
+        for task in (self.listening, self.syncing):
+            if task is not None:
+                task.cancel()
+
+    # Apply all committed changes after the last applied one. Nothing is
+    # applied before the tree is loaded, the load brings them in.
+    async def sync(self) -> None:
+        if not self.loaded:
+            return
+        async with self.lock:
+            missing: Dict[str, str] = {}
+            gone: Set[str] = set()
+            try:
+                while True:
+                    async with Session() as session:
+                        changes = await getChanges(
+                            session, self.seq, TREE_SYNC_BATCH
+                        )
+                    self._apply(changes, missing, gone)
+                    if len(changes) < TREE_SYNC_BATCH:
+                        return
+            finally:
+                self._settle(missing, gone)
+
+    # Changes are applied in runs: deletions one by one, consecutive
+    # writes together, so a unit and its new parent may come in any order.
+    # Units whose parents are not in the tree yet are collected in
+    # `missing`, their parents may come in a later batch. Units without
+    # a current state were deleted later in the log, maybe with a folder
+    # they were moved to meanwhile, and are collected in `gone`. Both are
+    # handled by _settle once all batches are applied.
+    def _apply(self, changes: List, missing: Dict[str, str], gone: Set[str]) -> None:
+        written = []
+        for change in changes:
+            if change.deleted:
+                self._write(written, missing, gone)
+                written = []
+                self.index.delete(change.unit_id)
+            elif change.id is None:
+                gone.add(change.unit_id)
+            else:
+                written.append(change)
+            self.seq = change.seq
+        self._write(written, missing, gone)
+
+    def _write(self, rows: List, missing: Dict[str, str], gone: Set[str]) -> None:
+        for row in rows:
+            missing.pop(row.id, None)
+            gone.discard(row.id)
+        missing.update(self.index.link(self.index.write(rows)))
+
+    # Link the units whose parents were missing, then remove the units
+    # deleted later in the log with what is still below them.
+    def _settle(self, missing: Dict[str, str], gone: Set[str]) -> None:
+        slots = self.index.slots
+        links = [
+            (slots[id], parentId) for id, parentId in missing.items() if id in slots
+        ]
+        warn_missing(self.index.link(links))
+        for id in gone:
+            self.index.delete(id)
+
+    def _notified(self) -> None:
+        self.dirty = True
+        if self.syncing is None or self.syncing.done():
+            self.syncing = asyncio.create_task(self._drain())
+
+    async def _drain(self) -> None:
+        while self.dirty:
+            self.dirty = False
+            try:
+                await self.sync()
+            except Exception:
+                logger.exception("tree: sync failed")
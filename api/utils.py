@@ -1,5 +1,10 @@
-from datetime import datetime
+import base64
+import binascii
+import calendar
+from datetime import datetime, timezone
+from typing import Tuple
 
+import orjson
 from dateutil import parser
 
 
@@ -14,3 +19,42 @@ def str_to_time(s: str) -> datetime | None:
 # convert date to string using ISO 8601
 def time_to_str(date: datetime) -> str:
     return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# convert date to naive UTC datetime as it is stored in the database
+def to_utc(date: datetime) -> datetime:
+    if date.tzinfo is None:
+        return date
+    return date.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+# encode (date, id) key of the last returned item as an opaque page cursor
+def encode_cursor(date: datetime, id: str) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps([date.isoformat(), id])).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str] | None:
+    try:
+        date, id = orjson.loads(base64.urlsafe_b64decode(cursor))
+        return datetime.fromisoformat(date), str(id)
+    except (binascii.Error, orjson.JSONDecodeError, TypeError, ValueError):
+        return None
+
+
+# Strong ETag of a unit state from its version and date, None for units
+# written before versions were introduced. Versions never repeat, the date
+# makes the tag readable and guards against a reset sequence.
+def make_etag(version: int | None, date: datetime) -> str | None:
+    if version is None:
+        return None
+    return f'"{version}-{calendar.timegm(date.utctimetuple())}"'
+
+
+# whether an If-None-Match header matches the ETag, compared weakly
+def etag_matches(header: str | None, etag: str | None) -> bool:
+    if header is None or etag is None:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = (tag.strip() for tag in header.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in tags)
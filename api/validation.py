@@ -0,0 +1,82 @@
+from typing import Dict, List, Tuple
+
+from config import STRING_SIZE
+from models import SystemItemImport, SystemItemType
+
+# the longest url a file may have, see openapi.yaml
+MAX_URL_LENGTH = 255
+
+
+class ValidationFailed(Exception):
+    """Imported data break the rules of openapi.yaml, answered with 400."""
+
+
+# check the rules that concern a single imported item
+def check_item(item: SystemItemImport) -> None:
+    if len(item.id) > STRING_SIZE or item.id == item.parentId:
+        raise ValidationFailed(f"invalid id {item.id}")
+    if item.parentId is not None and len(item.parentId) > STRING_SIZE:
+        raise ValidationFailed(f"invalid parentId of {item.id}")
+    if item.type == SystemItemType.FOLDER:
+        if item.url is not None or item.size is not None:
+            raise ValidationFailed(f"folder {item.id} has url or size")
+    else:
+        if item.size is None or item.size <= 0:
+            raise ValidationFailed(f"file {item.id} has no positive size")
+        if item.url is not None and len(item.url) > MAX_URL_LENGTH:
+            raise ValidationFailed(f"url of file {item.id} is too long")
+
+
+# Check an import batch against the existing units it references and
+# return its items with parents before children. `known` maps ids of the
+# imported units, their parents and all their ancestors that exist to
+# (type, parentId), see getReferenced. Work is linear in the batch and
+# the referenced chains, nothing is read from the database.
+def check_batch(
+    items: List[SystemItemImport],
+    known: Dict[str, Tuple[SystemItemType, str | None]],
+) -> List[SystemItemImport]:
+    batch: Dict[str, SystemItemImport] = {}
+    for item in items:
+        check_item(item)
+        if item.id in batch:
+            raise ValidationFailed(f"duplicate id {item.id}")
+        if item.id in known and known[item.id][0] != item.type:
+            raise ValidationFailed(f"type of {item.id} cannot change")
+        batch[item.id] = item
+
+    def parent_of(id: str) -> str | None:
+        if id in batch:
+            return batch[id].parentId
+        return known.get(id, (None, None))[1]
+
+    for item in items:
+        if item.parentId is None:
+            continue
+        if item.parentId in batch:
+            parent_type = batch[item.parentId].type
+        else:
+            parent_type = known.get(item.parentId, (None, None))[0]
+        if parent_type != SystemItemType.FOLDER:
+            raise ValidationFailed(f"parent of {item.id} is not a folder")
+
+    # Walk up from every item in the hierarchy after the import. A chain
+    # that reaches a unit on the current path is a cycle, the one that
+    # reaches a root or a unit walked before is fine.
+    ordered: List[SystemItemImport] = []
+    done = set()
+    for item in items:
+        path = []
+        on_path = set()
+        id = item.id
+        while id is not None and id not in done:
+            if id in on_path:
+                raise ValidationFailed(f"{id} would be its own ancestor")
+            path.append(id)
+            on_path.add(id)
+            id = parent_of(id)
+        for id in reversed(path):
+            done.add(id)
+            if id in batch:
+                ordered.append(batch[id])
+    return ordered
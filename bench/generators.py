@@ -0,0 +1,97 @@
+"""Synthetic disk trees for benchmarks.
+
+Every generator returns a list of units in import order (parents before
+children) as SystemItemImport dicts. `batches` splits them into
+/imports request bodies.
+"""
+import random
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List
+
+Item = Dict[str, object]
+
+
+def folder(id: str, parentId: str | None) -> Item:
+    return {"id": id, "type": "FOLDER", "parentId": parentId}
+
+
+def file(id: str, parentId: str | None, size: int) -> Item:
+    return {
+        "id": id,
+        "type": "FILE",
+        "parentId": parentId,
+        "url": f"/file/{id}",
+        "size": size,
+    }
+
+
+# one root folder with `size - 1` files in it
+def wide_tree(size: int, prefix: str = "wide") -> List[Item]:
+    root = f"{prefix}-root"
+    return [folder(root, None)] + [
+        file(f"{prefix}-{i}", root, i + 1) for i in range(size - 1)
+    ]
+
+
+# a chain of `depth` folders with the remaining units as files spread along it
+def deep_tree(size: int, depth: int = 50, prefix: str = "deep") -> List[Item]:
+    depth = max(1, min(depth, size))
+    items = []
+    parent = None
+    for level in range(depth):
+        items.append(folder(f"{prefix}-d{level}", parent))
+        parent = f"{prefix}-d{level}"
+    for i in range(size - depth):
+        items.append(file(f"{prefix}-{i}", f"{prefix}-d{i % depth}", i + 1))
+    return items
+
+
+# Random tree resembling a real disk: a fifth of the units are folders,
+# new units usually go to recently created folders, so branches get
+# several levels deep, and file sizes are log-normal.
+def realistic_tree(
+    size: int, seed: int = 0, max_depth: int = 12, prefix: str = "real"
+) -> List[Item]:
+    rng = random.Random(seed)
+    root = f"{prefix}-root"
+    items = [folder(root, None)]
+    folders = [root]
+    depth = {root: 0}
+    for i in range(size - 1):
+        # prefer the most recent folders, keep some chance for any folder
+        if rng.random() < 0.7:
+            parent = folders[-1 - min(int(rng.expovariate(0.5)), len(folders) - 1)]
+        else:
+            parent = rng.choice(folders)
+        id = f"{prefix}-{i}"
+        if rng.random() < 0.2 and depth[parent] < max_depth:
+            items.append(folder(id, parent))
+            folders.append(id)
+            depth[id] = depth[parent] + 1
+        else:
+            items.append(file(id, parent, int(rng.lognormvariate(10, 2)) + 1))
+    return items
+
+
+TREES = {
+    "wide": wide_tree,
+    "deep": deep_tree,
+    "realistic": realistic_tree,
+}
+
+
+def folders_of(items: List[Item]) -> List[str]:
+    return [item["id"] for item in items if item["type"] == "FOLDER"]
+
+
+# split units into /imports bodies with increasing update dates
+def batches(
+    items: List[Item], batch_size: int = 1000, start: datetime | None = None
+) -> Iterator[Dict[str, object]]:
+    date = start or datetime(2022, 1, 1)
+    for offset in range(0, len(items), batch_size):
+        yield {
+            "items": items[offset : offset + batch_size],
+            "updateDate": date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+        date += timedelta(minutes=1)
@@ -0,0 +1,272 @@
+"""Benchmark of the API against a local Postgres.
+
+The app is started in this process under uvicorn, so every SQL statement
+it runs can be counted with engine events. Database settings are read
+from the same environment variables as the app (see .env.example). The
+schema is migrated to the latest version and all tables are TRUNCATED
+before the run, never point it at a database with data you need.
+
+    python bench/run.py --tree realistic --size 10000 --concurrency 8
+    python bench/run.py --tree deep --depth 500 --scenarios import snapshot
+
+Results (latency percentiles, throughput, SQL statements and time per
+scenario) are printed and written to --output as JSON.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "api")
+sys.path.insert(0, os.path.abspath(API_DIR))
+os.environ.setdefault("MODE", "PRODUCTION")
+
+import uvicorn  # noqa: E402
+from alembic import command  # noqa: E402
+from alembic.config import Config  # noqa: E402
+from sqlalchemy import create_engine, event, text  # noqa: E402
+
+import main  # noqa: E402
+from config import (  # noqa: E402
+    DATABASE_HOST,
+    DATABASE_PORT,
+    POSTGRES_DB,
+    POSTGRES_PASSWORD,
+    POSTGRES_USER,
+)
+from database import engine  # noqa: E402
+from generators import TREES, batches, folders_of  # noqa: E402
+
+Call = Callable[[], int]
+
+
+class SqlCounter:
+    """Counts statements and their time on the app engine."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = 0
+        self.seconds = 0.0
+        event.listen(engine.sync_engine, "before_cursor_execute", self.before)
+        event.listen(engine.sync_engine, "after_cursor_execute", self.after)
+
+    def before(self, conn, cursor, statement, parameters, context, executemany):
+        context._bench_start = time.perf_counter()
+
+    def after(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._bench_start
+        with self.lock:
+            self.statements += 1
+            self.seconds += elapsed
+
+    def reset(self) -> None:
+        with self.lock:
+            self.statements = 0
+            self.seconds = 0.0
+
+
+class Server(uvicorn.Server):
+    def install_signal_handlers(self) -> None:
+        pass
+
+
+def start_server(port: int) -> Server:
+    server = Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def reset_database() -> None:
+    config = Config(os.path.join(API_DIR, "alembic.ini"))
+    config.set_main_option("script_location", os.path.join(API_DIR, "migrations"))
+    command.upgrade(config, "head")
+    sync_engine = create_engine(
+        f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DATABASE_HOST}:{DATABASE_PORT}/{POSTGRES_DB}"
+    )
+    with sync_engine.begin() as connection:
+        connection.execute(text("TRUNCATE unit, unit_tree, history, change_log"))
+    sync_engine.dispose()
+
+
+def request(url: str, method: str = "GET", data: Dict | None = None) -> int:
+    body = json.dumps(data).encode() if data is not None else None
+    req = urllib.request.Request(url, data=body, method=method)
+    if body is not None:
+        req.add_header("Content-Type", "application/json")
+    try:
+        with urllib.request.urlopen(req) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def percentile(latencies: List[float], q: int) -> float:
+    if len(latencies) == 1:
+        return latencies[0]
+    return statistics.quantiles(latencies, n=100, method="inclusive")[q - 1]
+
+
+def run(calls: List[Call], concurrency: int, counter: SqlCounter) -> Dict:
+    def timed(call: Call) -> Tuple[float, int]:
+        start = time.perf_counter()
+        status = call()
+        return time.perf_counter() - start, status
+
+    counter.reset()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, calls))
+    wall = time.perf_counter() - start
+
+    latencies = [latency * 1000 for latency, _ in results]
+    statuses: Dict[str, int] = {}
+    for _, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "requests": len(calls),
+        "concurrency": concurrency,
+        "statuses": statuses,
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": max(latencies),
+        "throughput_rps": len(calls) / wall,
+        "sql_statements": counter.statements,
+        "sql_per_request": counter.statements / len(calls),
+        "sql_ms": counter.seconds * 1000,
+    }
+
+
+def main_(args: argparse.Namespace) -> Dict:
+    rng = random.Random(args.seed)
+    if args.tree == "deep":
+        items = TREES["deep"](args.size, depth=args.depth)
+    elif args.tree == "realistic":
+        items = TREES["realistic"](args.size, seed=args.seed)
+    else:
+        items = TREES[args.tree](args.size)
+    folders = folders_of(items)
+    ids = [item["id"] for item in items]
+
+    reset_database()
+    if args.no_cache:
+        main.node_cache.max_bytes = 0
+    server = start_server(args.port)
+    counter = SqlCounter()
+    base = f"http://127.0.0.1:{args.port}"
+
+    bodies = list(batches(items, args.batch_size))
+    last_date = bodies[-1]["updateDate"]
+    # trees rebuilt from history as they were halfway through the import
+    middle_date = bodies[len(bodies) // 2]["updateDate"]
+
+    def post(body: Dict) -> Call:
+        return lambda: request(f"{base}/imports/", "POST", body)
+
+    def get(path: str, **params) -> Call:
+        query = f"?{urllib.parse.urlencode(params)}" if params else ""
+        return lambda: request(f"{base}{path}{query}")
+
+    def delete(id: str) -> Call:
+        query = urllib.parse.urlencode({"date": last_date})
+        return lambda: request(f"{base}/delete/{id}?{query}", "DELETE")
+
+    scenarios: Dict[str, Tuple[List[Call], int]] = {
+        # imports depend on each other, so they always run one by one
+        "import": ([post(body) for body in bodies], 1),
+        "nodes": (
+            [get(f"/nodes/{rng.choice(folders)}") for _ in range(args.requests)],
+            args.concurrency,
+        ),
+        "shallow": (
+            [
+                get(f"/nodes/{rng.choice(folders)}", depth=1)
+                for _ in range(args.requests)
+            ],
+            args.concurrency,
+        ),
+        "snapshot": (
+            [
+                get(f"/nodes/{rng.choice(folders)}", at=middle_date)
+                for _ in range(args.requests)
+            ],
+            args.concurrency,
+        ),
+        "updates": (
+            [get("/updates/", date=last_date) for _ in range(args.requests)],
+            args.concurrency,
+        ),
+        "history": (
+            [get(f"/node/{rng.choice(ids)}/history") for _ in range(args.requests)],
+            args.concurrency,
+        ),
+        "delete": (
+            [delete(id) for id in rng.sample(folders, min(args.deletes, len(folders)))],
+            1,
+        ),
+    }
+
+    results = {}
+    for name in args.scenarios:
+        calls, concurrency = scenarios[name]
+        results[name] = run(calls, concurrency, counter)
+        if name == "import":
+            results[name]["items_per_second"] = len(items) / (
+                results[name]["requests"] / results[name]["throughput_rps"]
+            )
+        print(
+            f"{name:8} p50 {results[name]['p50_ms']:8.1f} ms"
+            f"  p95 {results[name]['p95_ms']:8.1f} ms"
+            f"  p99 {results[name]['p99_ms']:8.1f} ms"
+            f"  {results[name]['throughput_rps']:8.1f} rps"
+            f"  {results[name]['sql_per_request']:7.1f} sql/request"
+        )
+
+    server.should_exit = True
+    return {"config": vars(args), "units": len(items), "scenarios": results}
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--tree", choices=sorted(TREES), default="realistic")
+    parser.add_argument("--size", type=int, default=5000, help="units in the tree")
+    parser.add_argument("--depth", type=int, default=50, help="depth of deep trees")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=200, help="per read scenario")
+    parser.add_argument("--deletes", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        choices=[
+            "import", "nodes", "shallow", "snapshot", "updates", "history", "delete"
+        ],
+        default=["import", "nodes", "updates", "history", "delete"],
+    )
+    parser.add_argument("--no-cache", action="store_true", help="disable /nodes cache")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--output", default="bench_results.json")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = main_(args)
+    with open(args.output, "w") as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to {args.output}")
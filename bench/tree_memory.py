@@ -0,0 +1,69 @@
+"""Memory of the in-memory tree engine (api/tree.py) per unit.
+
+Builds TreeIndex from a synthetic tree without a database and reports the
+bytes allocated while building it, measured with tracemalloc, next to the
+estimate of TreeIndex.memory(). The app modules read the same environment
+variables as the app (see .env.example), but no connection is made.
+
+    python bench/tree_memory.py --tree realistic --size 100000
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+from collections import namedtuple
+from datetime import datetime
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "api")
+sys.path.insert(0, os.path.abspath(API_DIR))
+os.environ.setdefault("MODE", "PRODUCTION")
+
+from generators import TREES  # noqa: E402
+from models import SystemItemType  # noqa: E402
+from tree import TreeIndex  # noqa: E402
+
+Row = namedtuple("Row", ["id", "url", "date", "parentId", "type", "size", "version"])
+
+
+def copy(string: str | None) -> str | None:
+    return None if string is None else string.encode().decode()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tree", choices=sorted(TREES), default="realistic")
+    parser.add_argument("--size", type=int, default=100000, help="units in the tree")
+    args = parser.parse_args()
+
+    items = TREES[args.tree](args.size)
+    date = datetime(2022, 10, 1)
+
+    tracemalloc.start()
+    # strings are copied as if they were read from the database, so the
+    # ones kept by the index are counted
+    rows = [
+        Row(
+            copy(item["id"]),
+            copy(item.get("url")),
+            date,
+            copy(item["parentId"]),
+            SystemItemType(item["type"]),
+            item.get("size"),
+            version,
+        )
+        for version, item in enumerate(items)
+    ]
+    index = TreeIndex()
+    index.link(index.write(rows))
+    del rows
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    units = len(index)
+    print(f"{args.tree} tree, {units} units")
+    print(f"allocated:  {allocated / units:8.1f} bytes per unit (tracemalloc)")
+    print(f"estimated:  {index.memory() / units:8.1f} bytes per unit (TreeIndex.memory)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# encoding=utf8
+
+# Concurrent writes against a running API, then a check that every folder
+# size is the sum of the files below it. Workers add, resize, move and
+# delete their own files in leaf folders shared by all workers and move
+# their own leaf folders between top folders.
+#
+#   python tests/stress_test.py http://localhost:80 --workers 16 --requests 100
+
+import argparse
+import itertools
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+API_BASEURL = "http://localhost:80"
+
+ROOT_ID = "stress-root"
+TOP_FOLDERS = 4
+LEAF_FOLDERS = 4
+
+START_DATE = datetime(2022, 3, 1)
+dates = itertools.count()
+dates_lock = threading.Lock()
+
+
+# every write gets its own date, so history states never collide
+def next_date():
+    with dates_lock:
+        seconds = next(dates)
+    return (START_DATE + timedelta(seconds=seconds)).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def request(path, method="GET", data=None):
+    if method == "GET":
+        res = requests.get(f"{API_BASEURL}{path}")
+    elif method == "POST":
+        res = requests.post(f"{API_BASEURL}{path}", json=data)
+    elif method == "DELETE":
+        res = requests.delete(f"{API_BASEURL}{path}")
+    return res.status_code, res.json() if res.content else None
+
+
+def import_items(items):
+    status, response = request(
+        "/imports/", "POST", {"items": items, "updateDate": next_date()}
+    )
+    assert status == 200, f"Expected HTTP status code 200, got {status}: {response}"
+
+
+def folder(id, parentId):
+    return {"type": "FOLDER", "id": id, "parentId": parentId}
+
+
+def file(id, parentId, size):
+    return {"type": "FILE", "id": id, "parentId": parentId, "size": size, "url": "/f"}
+
+
+def setup(workers):
+    status, _ = request(f"/nodes/{ROOT_ID}")
+    if status == 200:
+        status, _ = request(f"/delete/{ROOT_ID}?date={next_date()}", "DELETE")
+        assert status == 200, f"Expected HTTP status code 200, got {status}"
+    items = [folder(ROOT_ID, None)]
+    for top in range(TOP_FOLDERS):
+        items.append(folder(f"stress-top-{top}", ROOT_ID))
+        for worker in range(workers):
+            for leaf in range(LEAF_FOLDERS):
+                items.append(
+                    folder(f"stress-leaf-{worker}-{leaf}-{top}", f"stress-top-{top}")
+                )
+    import_items(items)
+
+
+def work(worker, workers, count, seed):
+    rng = random.Random(seed)
+    leaves = [
+        (f"stress-leaf-{other}-{leaf}-{top}", f"stress-top-{top}")
+        for other in range(workers)
+        for leaf in range(LEAF_FOLDERS)
+        for top in range(TOP_FOLDERS)
+    ]
+    own = [leaf for leaf in leaves if leaf[0].startswith(f"stress-leaf-{worker}-")]
+    files = {}
+    for n in range(count):
+        action = rng.random()
+        if action < 0.4 or not files:
+            id = f"stress-file-{worker}-{n}"
+            files[id] = (rng.choice(leaves)[0], rng.randint(1, 1000))
+            import_items([file(id, *files[id])])
+        elif action < 0.6:
+            id = rng.choice(list(files))
+            files[id] = (files[id][0], rng.randint(1, 1000))
+            import_items([file(id, *files[id])])
+        elif action < 0.75:
+            id = rng.choice(list(files))
+            files[id] = (rng.choice(leaves)[0], files[id][1])
+            import_items([file(id, *files[id])])
+        elif action < 0.9:
+            leaf = rng.choice(own)
+            top = f"stress-top-{rng.randrange(TOP_FOLDERS)}"
+            own[own.index(leaf)] = (leaf[0], top)
+            import_items([folder(leaf[0], top)])
+        else:
+            id = rng.choice(list(files))
+            del files[id]
+            status, _ = request(f"/delete/{id}?date={next_date()}", "DELETE")
+            assert status == 200, f"Expected HTTP status code 200, got {status}"
+    return sum(size for _, size in files.values())
+
+
+# size of every folder must be the sum of the files in its subtree
+def check_sizes(node):
+    if node["type"] == "FILE":
+        return node["size"]
+    total = sum(check_sizes(child) for child in node["children"])
+    assert node["size"] == total, f"{node['id']} has size {node['size']}, expected {total}"
+    return total
+
+
+def test_stress(workers, count, seed):
+    setup(workers)
+    with ThreadPoolExecutor(workers) as pool:
+        totals = list(
+            pool.map(
+                work,
+                range(workers),
+                [workers] * workers,
+                [count] * workers,
+                [seed + worker for worker in range(workers)],
+            )
+        )
+
+    status, tree = request(f"/nodes/{ROOT_ID}")
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    check_sizes(tree)
+    assert tree["size"] == sum(totals), f"Root size {tree['size']}, expected {sum(totals)}"
+    for top in tree["children"]:
+        status, subtree = request(f"/nodes/{top['id']}")
+        assert status == 200, f"Expected HTTP status code 200, got {status}"
+        assert subtree["size"] == top["size"], f"{top['id']} differs from the root tree"
+    print(f"Test stress passed: {workers * count} writes, root size {tree['size']}.")
+
+
+def main():
+    global API_BASEURL
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", nargs="?", default=API_BASEURL)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=100, help="per worker")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    API_BASEURL = args.url.rstrip("/")
+    print(f"Testing API on {API_BASEURL}")
+    test_stress(args.workers, args.requests, args.seed)
+
+
+if __name__ == "__main__":
+    main()
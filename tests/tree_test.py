@@ -0,0 +1,134 @@
+# encoding=utf8
+
+# Tests of the in-memory tree (api/tree.py) without a database: changes of
+# the log are applied to a TreeIndex the way TreeEngine.sync applies them.
+#
+#   python tests/tree_test.py
+
+import os
+import sys
+from collections import namedtuple
+from datetime import datetime
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "api")
+sys.path.insert(0, os.path.abspath(API_DIR))
+# no connection is made, the database settings only have to parse
+os.environ.setdefault("MODE", "PRODUCTION")
+os.environ.setdefault("DATABASE_PORT", "5432")
+
+from models import SystemItemType  # noqa: E402
+from tree import TreeEngine, TreeIndex  # noqa: E402
+
+DATE = datetime(2022, 10, 1)
+
+# a row of the change log joined with the current state of its unit
+Change = namedtuple(
+    "Change",
+    "seq unit_id deleted id url date parentId type size version",
+)
+
+
+def folder(seq, id, parentId, size=0):
+    type = SystemItemType.FOLDER
+    return Change(seq, id, False, id, None, DATE, parentId, type, size, seq)
+
+
+def file(seq, id, parentId, size):
+    type = SystemItemType.FILE
+    return Change(seq, id, False, id, "/file", DATE, parentId, type, size, seq)
+
+
+# a change of a unit deleted since, the join finds no current state
+def gone(seq, id):
+    return Change(seq, id, False, None, None, None, None, None, None, None)
+
+
+def deleted(seq, id):
+    return Change(seq, id, True, None, None, None, None, None, None, None)
+
+
+def engine_with(*rows):
+    engine = TreeEngine()
+    engine.index = TreeIndex()
+    assert engine.index.link(engine.index.write(rows)) == []
+    return engine
+
+
+def apply(engine, *batches):
+    missing, removed = {}, set()
+    for changes in batches:
+        engine._apply(list(changes), missing, removed)
+    engine._settle(missing, removed)
+
+
+def tree(engine, id):
+    units = engine.index.subtree(engine.index.find(id))
+    return [(unit.id, unit.parentId, unit.size) for unit in units]
+
+
+def test_moved_into_deleted_folder():
+    # x moved from a into b, then b deleted with it, both seen in one sync
+    engine = engine_with(
+        folder(1, "r", None, 5),
+        folder(2, "a", "r", 5),
+        folder(3, "b", "r"),
+        file(4, "x", "a", 5),
+    )
+    apply(
+        engine,
+        [gone(5, "x"), folder(5, "a", "r"), gone(5, "b"), folder(5, "r", None)],
+        [deleted(6, "b"), folder(6, "r", None)],
+    )
+    assert tree(engine, "r") == [("r", None, 0), ("a", "r", 0)]
+    assert engine.index.find("x") is None and engine.index.find("b") is None
+
+
+def test_parent_in_later_batch():
+    engine = engine_with(folder(1, "r", None))
+    apply(
+        engine,
+        [folder(2, "r", None, 5), file(2, "c", "f", 5)],
+        [folder(2, "f", "r", 5)],
+    )
+    assert tree(engine, "r") == [("r", None, 5), ("f", "r", 5), ("c", "f", 5)]
+
+
+def test_moved_out_of_deleted_folder():
+    # c moved from x into y with its file d, then x deleted
+    engine = engine_with(
+        folder(1, "r", None, 5),
+        folder(2, "x", "r", 5),
+        folder(3, "y", "r"),
+        folder(4, "c", "x", 5),
+        file(5, "d", "c", 5),
+    )
+    apply(
+        engine,
+        [folder(6, "c", "y", 5), gone(6, "x"), folder(6, "y", "r", 5)],
+        [deleted(7, "x"), folder(7, "r", None, 5)],
+    )
+    assert tree(engine, "r") == [
+        ("r", None, 5),
+        ("y", "r", 5),
+        ("c", "y", 5),
+        ("d", "c", 5),
+    ]
+
+
+def test_created_again():
+    # deleted when the first batch was read, created again before the second
+    engine = engine_with(folder(1, "r", None), file(2, "x", "r", 5))
+    apply(engine, [gone(3, "x")], [file(4, "x", "r", 7)])
+    assert tree(engine, "r") == [("r", None, 0), ("x", "r", 7)]
+
+
+def test_all():
+    test_moved_into_deleted_folder()
+    test_parent_in_later_batch()
+    test_moved_out_of_deleted_folder()
+    test_created_again()
+
+
+if __name__ == "__main__":
+    test_all()
+    print("Tree tests passed.")
@@ -7,6 +7,8 @@ import sys
 import urllib.error
 import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
 
 API_BASEURL = "https://army-2080.usr.yandex-academy.ru/"
@@ -210,6 +212,56 @@ def test_import():
     print("Test import passed.")
 
 
+INVALID_IMPORT_BATCHES = [
+    # folder with a size
+    [{"type": "FOLDER", "id": "invalid-folder", "parentId": None, "size": 10}],
+    # file without a positive size
+    [{"type": "FILE", "id": "invalid-file", "url": "/file/x", "parentId": None, "size": 0}],
+    # url longer than 255
+    [{"type": "FILE", "id": "invalid-file", "url": "/" * 256, "parentId": None, "size": 1}],
+    # duplicate ids
+    [
+        {"type": "FOLDER", "id": "invalid-folder", "parentId": None},
+        {"type": "FOLDER", "id": "invalid-folder", "parentId": None},
+    ],
+    # parent is a file
+    [
+        {
+            "type": "FILE",
+            "id": "invalid-file",
+            "url": "/file/x",
+            "parentId": "863e1a7a-1304-42ae-943b-179184c077e3",
+            "size": 1,
+        }
+    ],
+    # parent does not exist
+    [{"type": "FOLDER", "id": "invalid-folder", "parentId": "invalid-parent"}],
+    # folder turns into a file
+    [{"type": "FILE", "id": ROOT_ID, "url": "/file/x", "parentId": None, "size": 1}],
+    # root moves into its own subfolder
+    [
+        {
+            "type": "FOLDER",
+            "id": ROOT_ID,
+            "parentId": "d515e43f-f3f6-4471-bb77-6b455017a2d2",
+        }
+    ],
+]
+
+
+def test_validation():
+    for index, items in enumerate(INVALID_IMPORT_BATCHES):
+        batch = {"items": items, "updateDate": "2022-02-03T15:00:00Z"}
+        status, _ = request("/imports", method="POST", data=batch)
+        assert status == 400, f"Expected HTTP status code 400 for batch {index}, got {status}"
+
+    for id in ("invalid-folder", "invalid-file"):
+        status, _ = request(f"/nodes/{id}")
+        assert status == 404, f"Expected HTTP status code 404, got {status}"
+
+    print("Test validation passed.")
+
+
 def test_nodes():
     status, response = request(f"/nodes/{ROOT_ID}", json_response=True)
     # print(json.dumps(response, indent=2, ensure_ascii=False))
@@ -226,10 +278,151 @@ def test_nodes():
     print("Test nodes passed.")
 
 
+def test_nodes_batch():
+    params = urllib.parse.urlencode([("ids", ROOT_ID), ("ids", "missing-id")])
+    status, response = request(f"/nodes?{params}", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+
+    root, missing = response["items"]
+    deep_sort_children(root["node"])
+    deep_sort_children(EXPECTED_TREE)
+    if root["node"] != EXPECTED_TREE:
+        print_diff(EXPECTED_TREE, root["node"])
+        print("Response tree doesn't match expected tree.")
+        sys.exit(1)
+    assert missing["node"] is None and missing["error"]["code"] == 404
+
+    print("Test nodes batch passed.")
+
+
+# EXPECTED_TREE cut `depth` levels below the root, with children counts
+def cut_tree(node, depth):
+    if node["type"] == "FILE":
+        return node
+    cut = {**node, "childrenCount": len(node["children"])}
+    if depth == 0:
+        cut["children"] = None
+    else:
+        cut["children"] = [cut_tree(child, depth - 1) for child in node["children"]]
+    return cut
+
+
+def test_nodes_depth():
+    for depth in (0, 1, 2):
+        status, response = request(
+            f"/nodes/{ROOT_ID}?depth={depth}", json_response=True
+        )
+        assert status == 200, f"Expected HTTP status code 200, got {status}"
+
+        expected = cut_tree(EXPECTED_TREE, depth)
+        deep_sort_children(response)
+        deep_sort_children(expected)
+        if response != expected:
+            print_diff(expected, response)
+            print(f"Response tree with depth {depth} doesn't match expected tree.")
+            sys.exit(1)
+
+    status, _ = request(f"/nodes/{ROOT_ID}?depth=-1", json_response=True)
+    assert status == 400, f"Expected HTTP status code 400, got {status}"
+
+    print("Test nodes depth passed.")
+
+
+def test_etag():
+    for path in (f"/nodes/{ROOT_ID}", f"/node/{ROOT_ID}/history"):
+        res = requests.get(f"{API_BASEURL}{path}")
+        assert res.status_code == 200, f"Expected HTTP status code 200, got {res.status_code}"
+        etag = res.headers.get("ETag")
+        assert etag, f"No ETag in response of {path}"
+
+        res = requests.get(f"{API_BASEURL}{path}", headers={"If-None-Match": etag})
+        assert res.status_code == 304, f"Expected HTTP status code 304, got {res.status_code}"
+        assert res.headers.get("ETag") == etag and not res.content
+
+        res = requests.get(f"{API_BASEURL}{path}", headers={"If-None-Match": '"0-0"'})
+        assert res.status_code == 200, f"Expected HTTP status code 200, got {res.status_code}"
+
+    print("Test etag passed.")
+
+
+# the tree after the second import batch
+EXPECTED_TREE_AT = {
+    "type": "FOLDER",
+    "id": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1",
+    "size": 384,
+    "url": None,
+    "parentId": None,
+    "date": "2022-02-02T12:00:00Z",
+    "children": [
+        {
+            "type": "FOLDER",
+            "id": "d515e43f-f3f6-4471-bb77-6b455017a2d2",
+            "parentId": "069cb8d7-bbdd-47d3-ad8f-82ef4c269df1",
+            "size": 384,
+            "url": None,
+            "date": "2022-02-02T12:00:00Z",
+            "children": [
+                {
+                    "type": "FILE",
+                    "url": "/file/url1",
+                    "id": "863e1a7a-1304-42ae-943b-179184c077e3",
+                    "parentId": "d515e43f-f3f6-4471-bb77-6b455017a2d2",
+                    "size": 128,
+                    "date": "2022-02-02T12:00:00Z",
+                    "children": None,
+                },
+                {
+                    "type": "FILE",
+                    "url": "/file/url2",
+                    "id": "b1d8fd7d-2ae3-47d5-b2f9-0f094af800d4",
+                    "parentId": "d515e43f-f3f6-4471-bb77-6b455017a2d2",
+                    "size": 256,
+                    "date": "2022-02-02T12:00:00Z",
+                    "children": None,
+                },
+            ],
+        },
+    ],
+}
+
+
+def test_nodes_at():
+    params = urllib.parse.urlencode({"at": "2022-02-03T00:00:00Z"})
+    status, response = request(f"/nodes/{ROOT_ID}?{params}", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+
+    deep_sort_children(response)
+    deep_sort_children(EXPECTED_TREE_AT)
+    if response != EXPECTED_TREE_AT:
+        print_diff(EXPECTED_TREE_AT, response)
+        print("Response tree doesn't match expected tree.")
+        sys.exit(1)
+
+    params = urllib.parse.urlencode({"at": "2022-02-01T00:00:00Z"})
+    status, _ = request(f"/nodes/{ROOT_ID}?{params}", json_response=True)
+    assert status == 404, f"Expected HTTP status code 404, got {status}"
+
+    print("Test nodes at date passed.")
+
+
+# files of EXPECTED_TREE updated in the 24 hours before 2022-02-04
+def updated_files(node):
+    if node["type"] == "FILE":
+        return [node["id"]] if node["date"] >= "2022-02-03T00:00:00Z" else []
+    return [id for child in node["children"] for id in updated_files(child)]
+
+
 def test_updates():
     params = urllib.parse.urlencode({"date": "2022-02-04T00:00:00Z"})
     status, response = request(f"/updates?{params}", json_response=True)
     assert status == 200, f"Expected HTTP status code 200, got {status}"
+    # without a limit every update comes in one response
+    expected = sorted(updated_files(EXPECTED_TREE))
+    assert sorted(item["id"] for item in response["items"]) == expected
+
+    res = requests.get(f"{API_BASEURL}/updates?{params}&limit=1")
+    assert res.status_code == 200, f"Expected HTTP status code 200, got {res.status_code}"
+    assert len(res.json()["items"]) == 1 and res.headers.get("X-Next-Cursor")
     print("Test updates passed.")
 
 
@@ -239,6 +432,16 @@ def test_history():
     )
     status, response = request(f"/node/{ROOT_ID}/history?{params}", json_response=True)
     assert status == 200, f"Expected HTTP status code 200, got {status}"
+
+    # without a limit every state comes in one response, one per import
+    status, response = request(f"/node/{ROOT_ID}/history", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    dates = [item["date"] for item in response["items"]]
+    assert len(dates) == len(IMPORT_BATCHES) and dates == sorted(dates), dates
+
+    res = requests.get(f"{API_BASEURL}/node/{ROOT_ID}/history?limit=1")
+    assert res.status_code == 200, f"Expected HTTP status code 200, got {res.status_code}"
+    assert len(res.json()["items"]) == 1 and res.headers.get("X-Next-Cursor")
     print("Test stats passed.")
 
 
@@ -253,12 +456,75 @@ def test_delete():
     print("Test delete passed.")
 
 
+CHANGED_FILE = {
+    "type": "FILE",
+    "id": "c1f3a5d2-8a8e-4d4f-9d0e-6f1e7c4c2b11",
+    "url": "/file/changed",
+    "parentId": None,
+    "size": 64,
+}
+
+
+def test_changes():
+    status, response = request("/changes?wait=0", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    assert response["items"] == []
+    seq = response["seq"]
+
+    # a long-poll waiting for the import
+    with ThreadPoolExecutor(1) as pool:
+        poll = pool.submit(request, f"/changes?since={seq}&wait=10", json_response=True)
+        status, _ = request(
+            "/imports",
+            method="POST",
+            data={"items": [CHANGED_FILE], "updateDate": "2022-02-05T12:00:00Z"},
+        )
+        assert status == 200, f"Expected HTTP status code 200, got {status}"
+        status, response = poll.result()
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    change = response["items"][0]
+    assert change["id"] == CHANGED_FILE["id"] and not change["deleted"]
+    assert change["item"] == {**CHANGED_FILE, "date": "2022-02-05T12:00:00Z"}
+    assert response["seq"] == change["seq"] > seq
+
+    # the deletion of the root folder is kept in the log
+    status, response = request("/changes?since=0&wait=0", json_response=True)
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+    assert {"id": ROOT_ID, "deleted": True} in [
+        {"id": change["id"], "deleted": change["deleted"]}
+        for change in response["items"]
+    ]
+
+    with requests.get(
+        f"{API_BASEURL}/changes/stream",
+        headers={"Last-Event-ID": str(seq)},
+        stream=True,
+        timeout=10,
+    ) as res:
+        assert res.status_code == 200, f"Expected HTTP status code 200, got {res.status_code}"
+        lines = res.iter_lines(decode_unicode=True)
+        assert next(lines) == f"id: {change['seq']}"
+        assert json.loads(next(lines).removeprefix("data: ")) == change
+
+    params = urllib.parse.urlencode({"date": "2022-02-05T13:00:00Z"})
+    status, _ = request(f"/delete/{CHANGED_FILE['id']}?{params}", method="DELETE")
+    assert status == 200, f"Expected HTTP status code 200, got {status}"
+
+    print("Test changes passed.")
+
+
 def test_all():
     test_import()
+    test_validation()
     test_nodes()
+    test_nodes_batch()
+    test_nodes_depth()
+    test_etag()
+    test_nodes_at()
     test_updates()
     test_history()
     test_delete()
+    test_changes()
 
 
 def main():